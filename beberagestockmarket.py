@@ -1,7 +1,23 @@
+import os
 import re
-from datetime import timedelta, datetime
+import string
+import time
+import csv
+import sys
+import zlib
+import operator
+import functools
+from array import array
+import threading
+from bisect import bisect_left
+from itertools import islice
+from collections import deque, OrderedDict
+from math import log, exp
+from datetime import timedelta, datetime, timezone
 import numpy as np
-from scipy.stats.mstats import gmean
+
+PERCENTAGE = re.compile(r'(\d+(\.\d+)?)\%')       # fixed dividend as a percentage
+OPS = {'buy': 'buy', 'sell': 'sell'}                # interned operations: every trade shares the same strings
 
 
 class Stock:  # This is a single stock with all info inside
@@ -21,15 +37,22 @@ class Stock:  # This is a single stock with all info inside
         dividend yield: given a price
         P/E ratio or PER: given a price
 
+    Stock.from_csv(path) loads a registry of stocks ({symbol: Stock}) from a csv file with columns
+    symbol, stock_type, last_dividend, fix_dividend and par_value
+
+    Stocks have no instance dictionary (__slots__) and their symbols are interned.
+
     """
 
+    __slots__ = ('symbol', 'stock_type', 'last_dividend', 'par_value', 'fixed_dividend')
+
     def __init__(self, symbol, stock_type, last_dividend, par_value, fixed_dividend=None) :
 
         if len(symbol.strip()) != 3:
             raise Exception("Symbol {symbol} must have 3 characters and has {number}".format(number=len(symbol.strip()),
                                                                                              symbol=symbol.strip()))
         else:
-            self.symbol = symbol.strip().upper()
+            self.symbol = sys.intern(symbol.strip().upper())
         if stock_type.lower() not in ['common', 'preferred']:
             raise Exception("Only common or preferred values are admitted")
         else:
@@ -46,9 +69,8 @@ class Stock:  # This is a single stock with all info inside
             if isinstance(fixed_dividend, (int, float)):
                 self.fixed_dividend = fixed_dividend / 100
             else:
-                r = re.compile('(\d+(\.\d+)?)\%')
                 percentage = fixed_dividend.replace(' ', '')
-                if r.match(percentage):
+                if PERCENTAGE.match(percentage):
                     self.fixed_dividend = float(percentage.strip('%')) / 100
                 else:
                     try:
@@ -63,6 +85,17 @@ class Stock:  # This is a single stock with all info inside
     def __str__(self):
         return self.symbol
 
+    @classmethod
+    def from_csv(cls, path):        # registry of stocks by symbol
+        registry = {}
+        with open(path, mode='r', newline='') as csv_file:
+            for row in csv.DictReader(csv_file, skipinitialspace=True):
+                row = {key.strip(): value.strip() for key, value in row.items()}
+                stock = cls(row['symbol'], row['stock_type'], float(row['last_dividend']), float(row['par_value']),
+                            fixed_dividend=row.get('fix_dividend') or None)
+                registry[stock.symbol] = stock
+        return registry
+
     def dividend_yield(self, price):    # it calculates the dividend yield for a given stock
         if price == 0:
             raise Exception("Divide by 0!")
@@ -80,6 +113,66 @@ class Stock:  # This is a single stock with all info inside
             return price / (self.fixed_dividend * self.par_value)
 
 
+class StockUniverse:    # many stocks as arrays: dividend yield and P/E ratio for whole price vectors at once
+
+    """
+    holds the dividend data of many stocks as arrays
+
+    universe = StockUniverse(stocks): stocks as a list or a registry ({symbol: Stock})
+
+    operations:
+        dividend yields: given prices
+        P/E ratios or PERs: given prices
+
+    prices: an array whose last axis follows the universe stocks (a vector, or a matrix with a row per tick)
+            or, given symbols, follows those symbols
+    Results are masked arrays: no dividend yield for a price 0, no P/E ratio without dividend (masked
+    instead of exceptions or None)
+
+    """
+
+    def __init__(self, stocks):
+        self.stocks = list(stocks.values()) if isinstance(stocks, dict) else list(stocks)
+        self.codes = {stock.symbol: code for code, stock in enumerate(self.stocks)}
+        self.last_dividend = np.array([x.last_dividend for x in self.stocks], dtype=np.float64)
+        self.par_value = np.array([x.par_value for x in self.stocks], dtype=np.float64)
+        self.fixed_dividend = np.array([x.fixed_dividend for x in self.stocks], dtype=np.float64)
+        self.preferred = np.array([x.stock_type == 'preferred' for x in self.stocks], dtype=bool)
+        self.dividend = np.where(self.preferred, self.fixed_dividend * self.par_value, self.last_dividend)
+        self.no_ratio = (self.last_dividend == 0) | (self.par_value == 0) | (self.dividend == 0)
+
+    def __len__(self):
+        return len(self.stocks)
+
+    def __getitem__(self, symbol):
+        return self.stocks[self.codes[symbol]]
+
+    def positions(self, symbols):      # universe positions of some symbols
+        try:
+            return np.array([self.codes[x] for x in symbols], dtype=np.intp)
+        except KeyError as error:
+            raise Exception('Stock {} does not exist'.format(error.args[0]))
+
+    def _select(self, prices, symbols):     # prices and the universe positions they follow
+        prices = np.asarray(prices, dtype=np.float64)
+        positions = np.arange(len(self.stocks)) if symbols is None else self.positions(symbols)
+        if prices.shape[-1:] != positions.shape:
+            raise Exception('Expected {} prices per row and got {}'.format(len(positions), prices.shape[-1:]))
+        return prices, positions
+
+    def dividend_yield(self, prices, symbols=None):     # masked where the price is 0
+        prices, positions = self._select(prices, symbols)
+        dividends = np.broadcast_to(self.dividend[positions], prices.shape)
+        mask = prices == 0
+        return np.ma.masked_array(dividends / np.where(mask, 1, prices), mask=mask)
+
+    def pe_ratio(self, prices, symbols=None):   # masked where the stock has no dividend
+        prices, positions = self._select(prices, symbols)
+        dividends = self.dividend[positions]
+        mask = np.broadcast_to(self.no_ratio[positions], prices.shape)
+        return np.ma.masked_array(prices / np.where(self.no_ratio[positions], 1, dividends), mask=mask)
+
+
 class Trade:  # a single trade with all info needed. If timestamp is None then will get time now
 
     """
@@ -89,16 +182,21 @@ class Trade:  # a single trade with all info needed. If timestamp is None then w
         quantity: integer value
         op: just 2 options ... "sell" or "buy"
         price: numeric value
-        timestamp: on ISO format. If is passed as None it will take the time at that moment
+        timestamp: datetime, ISO string or epoch nanoseconds. If is passed as None it will take the time at that moment
+
+    Trades have no instance dictionary (__slots__). The symbol is read from the stock and operations are
+    interned, so millions of trades share them.
+    The timestamp is kept as int epoch nanoseconds UTC (ns). trade.timestamp gives it back as a naive UTC datetime.
 
     """
 
+    __slots__ = ('stock', 'quantity', 'op', 'price', 'ns')
+
     def __init__(self, stock, quantity, op, price, timestamp=None):
 
         if type(stock) != Stock:
             raise Exception('No stock received')
         self.stock = stock
-        self.symbol = stock.symbol          # Necessary for filters
         if type(quantity) != int:
             raise Exception('Quantity must be integer')
         else:
@@ -107,53 +205,1311 @@ class Trade:  # a single trade with all info needed. If timestamp is None then w
             raise Exception("Price should be a numeric value")
         else:
             self.price = price
-        if op.lower() not in ['sell', 'buy']:
+        if op.lower() not in OPS:
             raise Exception("You should indicate a 'sell' or 'buy' operation")
-        self.op = op.lower()
-        if timestamp:
+        self.op = OPS[op.lower()]
+        if timestamp is not None:
             try:
-                datetime.strftime(timestamp, '%Y-%m%dT%H:%M:%S.%f')
-                self.timestamp = timestamp
-            except ValueError:
+                self.ns = to_ns(timestamp)
+            except (ValueError, TypeError):
                 raise Exception("Time stamp is not in ISO format: YYYY-MM-DDTHH:MM:SS.mmmm")
         else:
-            self.timestamp = datetime.utcnow().isoformat()
+            self.ns = to_ns(datetime.utcnow())
 
     def __str__(self):
         return self.stock.symbol
 
+    @property
+    def symbol(self):       # Necessary for filters
+        return self.stock.symbol
+
+    @property
+    def timestamp(self):
+        return from_ns(self.ns)
+
+    @classmethod
+    def _restore(cls, stock, quantity, op, price, ns):      # rebuilds an already checked trade. No validation
+        trade = cls.__new__(cls)
+        trade.stock = stock
+        trade.quantity = quantity
+        trade.price = price
+        trade.op = op
+        trade.ns = ns
+        return trade
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def gmean(values):      # geometric mean as the exponential of the mean of the logarithms, as scipy gmean does
+    with np.errstate(divide='ignore', invalid='ignore'):    # 0 for a price 0, nan for a negative one
+        return float(np.exp(np.mean(np.log(np.asarray(values, dtype=np.float64)))))
+
+
+def to_ns(timestamp):   # datetime, numpy datetime64, ISO string or epoch nanoseconds to epoch nanoseconds (UTC)
+    # naive times are UTC. Bad strings and NaT raise ValueError, any other type TypeError
+    if isinstance(timestamp, (int, np.integer)) and not isinstance(timestamp, bool):
+        return int(timestamp)
+    if isinstance(timestamp, np.datetime64):
+        if np.isnat(timestamp):
+            raise ValueError('Not a time')
+        return int(timestamp.astype('datetime64[ns]').astype(np.int64))
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    if not isinstance(timestamp, datetime):
+        raise TypeError('{} is not a time'.format(type(timestamp).__name__))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 9 + delta.microseconds * 1000
+
+
+def from_ns(ns):        # epoch nanoseconds to a naive UTC datetime
+    return EPOCH + timedelta(microseconds=int(ns) // 1000)
+
+
+def parse_iso(column):
+    """
+    Vectorized ISO 8601 parser: a column of strings to int64 epoch nanoseconds (UTC)
+    Format: YYYY-MM-DD[(T| )HH:MM[:SS[.fraction]]][Z|+HH:MM|-HH:MM]. Naive times are UTC
+    Strings are checked for the format and read by numpy as datetime64. Only the Z or offset suffixes are
+    handled here.
+    Empty strings give the minimum int64 (no time). Raises ValueError on any other string.
+    """
+    nanoseconds, valid = _parse_iso(column)
+    if not valid.all():
+        raise ValueError('Time stamp is not in ISO format: {}'.format(np.asarray(column, dtype=str)[~valid][0]))
+    return nanoseconds
+
+
+def _parse_iso(column):     # parse_iso without raising: the times and which strings were valid ones
+    text = np.ascontiguousarray(column, dtype=str)
+    number, width = len(text), max(text.dtype.itemsize // 4, 30)    # room for every position looked at below
+    codes = np.zeros((number, width), dtype=np.uint32)      # the characters of every string, changed below
+    codes[:, :text.dtype.itemsize // 4] = text.view(np.uint32).reshape(number, -1)
+    text = codes.view('U{}'.format(width)).reshape(number)      # the same memory as strings
+    rows = np.arange(number)
+    ends = np.char.str_len(text)
+    spaces = [ord(x) for x in string.whitespace]
+    spaced = np.flatnonzero(np.isin(codes[:, 0], spaces) | np.isin(codes[rows, np.maximum(ends - 1, 0)], spaces))
+    if len(spaced):
+        text[spaced] = np.char.strip(text[spaced])
+        ends[spaced] = np.char.str_len(text[spaced])
+    empty = ends == 0
+
+    zulu = ~empty & (codes[rows, np.maximum(ends - 1, 0)] == ord('Z'))
+    ends = ends - zulu
+    offset = (ends >= 16) & np.isin(codes[rows, np.maximum(ends - 6, 0)], (ord('+'), ord('-'))) & \
+        (codes[rows, np.maximum(ends - 3, 0)] == ord(':'))
+    ends = ends - 6 * offset
+    offset_minutes = np.zeros(number, dtype=np.int64)
+    at = np.flatnonzero(offset)
+    if len(at):     # +HH:MM or -HH:MM after the time
+        digits = codes[at[:, None], ends[at, None] + np.array([1, 2, 4, 5])].astype(np.int64) - ord('0')
+        good_digits = ((digits >= 0) & (digits <= 9)).all(axis=1)
+        sign = np.where(codes[at, ends[at]] == ord('-'), -1, 1)
+        offset_minutes[at] = np.where(good_digits, sign * ((digits[:, 0] * 10 + digits[:, 1]) * 60 +
+                                                          digits[:, 2] * 10 + digits[:, 3]), 0)
+        offset[at] = good_digits
+    suffixed = np.flatnonzero(zulu | offset)
+    if len(suffixed):   # the suffix is cut off: numpy reads the rest
+        codes[suffixed] = np.where(np.arange(width) >= ends[suffixed, None], 0, codes[suffixed])
+
+    def at_each(position, *characters):
+        return np.isin(codes[:, position], [ord(x) for x in characters])
+
+    # numpy reads many other forms (YYYY-MM, now, NaT...): only these lengths and separators get to it
+    valid = ((ends == 10) | (ends == 16) | (ends == 19) | ((ends >= 21) & (ends <= 29))) & \
+        ((codes[:, :4] - ord('0')) < 10).all(axis=1) & at_each(4, '-') & at_each(7, '-') & \
+        ((ends == 10) | (at_each(10, 'T', ' ') & at_each(13, ':'))) & ((ends <= 16) | at_each(16, ':')) & \
+        ((ends <= 19) | at_each(19, '.'))
+    valid[at[~offset[at]]] = False      # wrong offset digits
+    text[~valid] = ''
+    try:
+        times = text.astype('datetime64[ns]')
+    except ValueError:      # some date or time out of range, as 2019-02-29: found one by one
+        for row in np.flatnonzero(valid).tolist():
+            try:
+                np.datetime64(text[row], 'ns')
+            except ValueError:
+                valid[row] = False
+        text[~valid] = ''
+        times = text.astype('datetime64[ns]')
+    valid |= empty
+    nanoseconds = times.astype(np.int64)        # NaT (empty string) is the minimum int64
+    return np.where(offset & valid, nanoseconds - offset_minutes * 60 * 10 ** 9, nanoseconds), valid
+
+
+class TradeJournal:
+
+    """
+    Append-only binary journal of trades. A 16 bytes header (magic, version and record size) and then fixed
+    32 bytes records, little endian:
+        timestamp: int64 epoch nanoseconds (UTC)
+        price: float64
+        quantity: int64
+        symbol: 3 ascii bytes
+        op: int8 code. 0 for 'buy' and 1 for 'sell'
+
+    journal = TradeJournal(path): opens the journal for appending (creates it if needed). A torn last record,
+    left by a crash while writing, is cut off.
+    sync=True: every write reaches the disk (fsync) before returning. Otherwise it is flushed to the system.
+
+    operations:
+        write_trade, write_trades, write_columns, write_arrays: append trades
+        TradeJournal.records(path): every record as a read only memory map (numpy structured array, no copy)
+        TradeJournal.columns(path, stocks): TradeColumns over the mapped records. Only symbols are decoded,
+                                            the other columns are read straight from the file
+
+    Trading.from_journal(path, stocks) serves a trading from a journal and trading.record(path) writes every
+    trade added to a trading to a journal.
+
+    """
+
+    magic = b'TRADEJNL'
+    version = 1
+    header = np.dtype([('magic', 'S8'), ('version', '<u4'), ('size', '<u4')])
+    record = np.dtype({'names': ['timestamp', 'price', 'quantity', 'symbol', 'op', 'word'],
+                       'formats': ['<i8', '<f8', '<i8', 'S3', 'i1', '<u4'],
+                       'offsets': [0, 8, 16, 24, 27, 24], 'itemsize': 32})     # word: symbol and op read together
+
+    def __init__(self, path, sync=False):
+        self.path = path
+        self.sync = sync
+        self.file = open(path, 'a+b')
+        self.file.seek(0, os.SEEK_END)
+        length = self.file.tell()
+        if length == 0:
+            self.file.write(np.array([(self.magic, self.version, self.record.itemsize)], dtype=self.header).tobytes())
+            self._flush()
+        else:
+            self.check(path)
+            torn = (length - self.header.itemsize) % self.record.itemsize
+            if torn:
+                self.file.truncate(length - torn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _flush(self):
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+
+    @classmethod
+    def _records(cls, symbols, ops, quantities, prices, timestamps):
+        records = np.zeros(len(timestamps), dtype=cls.record)
+        records['timestamp'] = timestamps
+        records['price'] = prices
+        records['quantity'] = quantities
+        records['symbol'] = symbols
+        records['op'] = ops
+        return records
+
+    @classmethod
+    def encode(cls, columns, start=0):      # records of the column rows from start on
+        symbols = np.array([x.symbol.encode('ascii') for x in columns.stocks], dtype='S3')
+        return cls._records(symbols[columns['symbol'][start:]], columns['op'][start:], columns['quantity'][start:],
+                            columns['price'][start:], columns['timestamp'][start:])
+
+    def _write(self, records):
+        self.file.write(records.tobytes())
+        self._flush()
+
+    def write_trade(self, trade):
+        self.write_trades([trade])
+
+    def write_trades(self, trades):
+        self._write(self._records([x.symbol.encode('ascii') for x in trades],
+                                  [TradeColumns.ops.index(x.op) for x in trades], [x.quantity for x in trades],
+                                  [x.price for x in trades], [x.ns for x in trades]))
+
+    def write_columns(self, columns, start=0):      # rows from start on
+        self._write(self.encode(columns, start))
+
+    def write_arrays(self, stocks, codes, ops, quantities, prices, timestamps):    # as given to _add_arrays
+        symbols = np.array([x.symbol.encode('ascii') for x in stocks], dtype='S3')
+        self._write(self._records(symbols[codes], ops, quantities, prices, timestamps))
+
+    @classmethod
+    def check(cls, path):       # raises if the file isn't a journal
+        header = np.fromfile(path, dtype=cls.header, count=1)
+        if len(header) != 1 or header['magic'][0] != cls.magic or header['version'][0] != cls.version \
+                or header['size'][0] != cls.record.itemsize:
+            raise Exception('{} is not a trade journal'.format(path))
+
+    @classmethod
+    def records(cls, path):     # whole records only: a torn last one is left out
+        cls.check(path)
+        number = (os.path.getsize(path) - cls.header.itemsize) // cls.record.itemsize
+        if number == 0:
+            return np.zeros(0, dtype=cls.record)
+        return np.memmap(path, dtype=cls.record, mode='r', offset=cls.header.itemsize, shape=(number,))
+
+    @classmethod
+    def columns(cls, path, stocks):     # stocks: registry ({symbol: Stock}) or list of stocks
+        stocks = list(stocks.values()) if isinstance(stocks, dict) else list(stocks)
+        records = cls.records(path)
+        keys = records['word'] & 0xFFFFFF      # the 3 symbol bytes as a number
+        known = np.array([int.from_bytes(x.symbol.encode('ascii'), 'little') for x in stocks], dtype=np.uint32)
+        order = np.argsort(known)
+        found = np.minimum(np.searchsorted(known[order], keys), max(len(known) - 1, 0))
+        if len(keys) and (not len(known) or np.any(known[order][found] != keys)):
+            unknown = records['symbol'][known[order][found] != keys][0] if len(known) else records['symbol'][0]
+            raise Exception('Stock {} does not exist'.format(unknown.decode('ascii', 'replace')))
+        if len(keys) and not np.isin(records['op'], (0, 1)).all():
+            raise Exception('{} has trades which are neither buy nor sell'.format(path))
+        codes = order[found]
+        used = np.flatnonzero(np.bincount(codes, minlength=len(stocks)))     # only stocks traded are registered
+        lookup = np.zeros(len(stocks), dtype=np.int32)
+        lookup[used] = np.arange(len(used))
+        columns = TradeColumns.__new__(TradeColumns)
+        columns.stocks = [stocks[x] for x in used]
+        columns.codes = {x.symbol: code for code, x in enumerate(columns.stocks)}
+        columns.size = len(records)
+        columns.data = {'symbol': lookup[codes], 'op': records['op'], 'quantity': records['quantity'],
+                        'price': records['price'], 'timestamp': records['timestamp']}
+        return columns
+
+
+class TradeSnapshot:
+
+    """
+    Point in time snapshot of a trading and its stocks, as a numpy zip archive (npz) of columns:
+        stocks: symbol, stock_type, last_dividend, par_value and fixed_dividend arrays (the stock registry)
+        trades: symbol codes (dictionary encoded: index in the stock arrays, in the smallest integer type),
+                op codes, quantity, price and timestamp arrays
+        checksums: crc32 of every array, checked on load
+
+    TradeSnapshot.save(trading, path, compress=False): saves the trades of a trading (or a filtered one)
+                                                       compress: deflates the arrays
+    TradeSnapshot.load(path, columnar=True): (trading, stocks registry {symbol: Stock})
+    Saving and loading are bulk array writes and reads: no Trade object is pickled.
+
+    """
+
+    version = 1
+    stock_fields = ('stock_symbol', 'stock_type', 'last_dividend', 'par_value', 'fixed_dividend')
+    trade_fields = ('symbol', 'op', 'quantity', 'price', 'timestamp')
+
+    @classmethod
+    def _checksums(cls, arrays):
+        return np.array([zlib.crc32(np.ascontiguousarray(arrays[x])) for x in cls.stock_fields + cls.trade_fields],
+                        dtype=np.uint32)
+
+    @classmethod
+    def save(cls, trading, path, compress=False):
+        columns = trading._columns()
+        stocks = columns.stocks
+        arrays = {'stock_symbol': np.array([x.symbol for x in stocks], dtype='U3'),
+                  'stock_type': np.array([x.stock_type for x in stocks], dtype='U9'),
+                  'last_dividend': np.array([x.last_dividend for x in stocks], dtype=np.float64),
+                  'par_value': np.array([x.par_value for x in stocks], dtype=np.float64),
+                  'fixed_dividend': np.array([x.fixed_dividend for x in stocks], dtype=np.float64),
+                  'symbol': columns['symbol'].astype(np.min_scalar_type(max(len(stocks) - 1, 0))),
+                  'op': columns['op'], 'quantity': columns['quantity'], 'price': columns['price'],
+                  'timestamp': columns['timestamp']}
+        arrays['checksums'] = cls._checksums(arrays)
+        arrays['version'] = np.array([cls.version])
+        with open(path, 'wb') as snapshot:
+            (np.savez_compressed if compress else np.savez)(snapshot, **arrays)
+
+    @classmethod
+    def load(cls, path, columnar=True):
+        import zipfile
+        try:
+            with np.load(path) as snapshot:
+                arrays = {field: snapshot[field] for field in snapshot.files}
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+            raise Exception('{} is not a trading snapshot'.format(path))
+        if arrays.get('version', [None])[0] != cls.version or \
+                any(x not in arrays for x in cls.stock_fields + cls.trade_fields + ('checksums',)):
+            raise Exception('{} is not a trading snapshot'.format(path))
+        if not np.array_equal(cls._checksums(arrays), arrays['checksums']):
+            raise Exception('{} is corrupted'.format(path))
+
+        stocks = []
+        for symbol, stock_type, last_dividend, par_value, fixed_dividend in zip(
+                *(arrays[x].tolist() for x in cls.stock_fields)):
+            stock = Stock(symbol, stock_type, last_dividend, par_value, fixed_dividend * 100 or None)
+            stock.fixed_dividend = fixed_dividend   # as it was, without rounding through the percentage
+            stocks.append(stock)
+        trading = Trading(columnar=columnar)
+        trading._add_arrays(stocks, arrays['symbol'].astype(np.intp), arrays['op'], arrays['quantity'],
+                            arrays['price'], arrays['timestamp'])
+        return trading, {x.symbol: x for x in stocks}
+
+
+class TradeColumns:
+
+    """
+    Columnar storage for a trading. Each trade attribute lives in its own numpy array:
+        symbol: int32 code. Index in the stock registry (stocks)
+        op: int8 code. 0 for 'buy' and 1 for 'sell'
+        quantity: int64
+        price: float64
+        timestamp: int64 epoch nanoseconds (UTC)
+
+    Arrays grow in chunks (capacity doubles when full), so appending is amortized O(1).
+    share() gives columns over the same arrays (and stock registry) with their own size: appending past the
+    size of every other sharer doesn't change what they see. Trading takes care of who can append (the tip).
+    Trade objects are only built when asked for (trade and trades).
+    'stock' is accepted as an alias of the symbol column for filtering.
+
+    """
+
+    dtypes = {'symbol': np.int32, 'op': np.int8, 'quantity': np.int64, 'price': np.float64, 'timestamp': np.int64}
+    attributes = ('stock', 'symbol', 'op', 'quantity', 'price', 'timestamp')
+    ops = ('buy', 'sell')
+    chunk = 1024
+
+    def __init__(self):
+        self.stocks = []        # code -> Stock
+        self.codes = {}         # symbol -> code
+        self.size = 0
+        self.data = {field: np.empty(self.chunk, dtype=dtype) for field, dtype in self.dtypes.items()}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, field):   # the filled part of a column
+        return self.data[field][:self.size]
+
+    def column(self, attribute):
+        return self['symbol'] if attribute == 'stock' else self[attribute]
+
+    def code(self, stock):      # registers the stock on first use
+        code = self.codes.get(stock.symbol)
+        if code is None:
+            code = len(self.stocks)
+            self.stocks.append(stock)
+            self.codes[stock.symbol] = code
+        return code
+
+    def encode(self, attribute, value):     # translates a trade attribute value to its column value
+        if attribute == 'stock':
+            return self.codes.get(value.symbol, -1) if isinstance(value, Stock) else -1
+        if attribute == 'symbol':
+            return self.codes.get(value, -1)
+        if attribute == 'op':
+            return self.ops.index(value) if value in self.ops else -1
+        if attribute == 'timestamp':
+            return to_ns(value)
+        return value
+
+    def sort_key(self, attribute):      # column values that sort as the trade attribute does
+        if attribute in ('stock', 'symbol'):
+            ranks = np.empty(len(self.stocks), dtype=np.int32)
+            ranks[np.argsort([x.symbol for x in self.stocks], kind='stable')] = np.arange(len(self.stocks))
+            return ranks[self['symbol']]
+        return self[attribute]
+
+    def _reserve(self, number):     # mapped (read only) columns are full: the first append copies them
+        capacity = len(self.data['symbol'])
+        if self.size + number <= capacity:
+            return
+        while capacity < self.size + number:
+            capacity = max(capacity * 2, self.chunk)
+        for field, dtype in self.dtypes.items():
+            column = np.empty(capacity, dtype=dtype)
+            column[:self.size] = self.data[field][:self.size]
+            self.data[field] = column
+
+    def append(self, trade):
+        self._reserve(1)
+        row = self.size
+        self.data['symbol'][row] = self.code(trade.stock)
+        self.data['op'][row] = self.ops.index(trade.op)
+        self.data['quantity'][row] = trade.quantity
+        self.data['price'][row] = trade.price
+        self.data['timestamp'][row] = trade.ns
+        self.size += 1
+
+    def extend(self, trades):
+        number = len(trades)
+        self._reserve(number)
+        rows = slice(self.size, self.size + number)
+        self.data['symbol'][rows] = [self.code(x.stock) for x in trades]
+        self.data['op'][rows] = [self.ops.index(x.op) for x in trades]
+        self.data['quantity'][rows] = [x.quantity for x in trades]
+        self.data['price'][rows] = [x.price for x in trades]
+        self.data['timestamp'][rows] = [x.ns for x in trades]
+        self.size += number
+
+    def extend_arrays(self, stocks, codes, ops, quantities, prices, timestamps):     # codes point to stocks
+        number = len(codes)
+        self._reserve(number)
+        rows = slice(self.size, self.size + number)
+        lookup = np.asarray([self.code(x) for x in stocks], dtype=np.int32)
+        self.data['symbol'][rows] = lookup[codes]
+        self.data['op'][rows] = ops
+        self.data['quantity'][rows] = quantities
+        self.data['price'][rows] = prices
+        self.data['timestamp'][rows] = timestamps
+        self.size += number
+
+    def share(self):    # same arrays and registry, own size
+        columns = TradeColumns.__new__(TradeColumns)
+        columns.stocks = self.stocks
+        columns.codes = self.codes
+        columns.size = self.size
+        columns.data = self.data.copy()
+        return columns
+
+    def copy(self):     # own arrays and registry
+        columns = self.share()
+        columns.stocks = self.stocks.copy()
+        columns.codes = self.codes.copy()
+        columns.data = {field: column.copy() for field, column in self.data.items()}
+        return columns
+
+    def trade(self, row):       # builds the Trade object stored at a row
+        return Trade._restore(self.stocks[self.data['symbol'][row]],
+                              int(self.data['quantity'][row]),
+                              self.ops[self.data['op'][row]],
+                              float(self.data['price'][row]),
+                              int(self.data['timestamp'][row]))
+
+    def trades(self, rows):
+        return [self.trade(row) for row in rows]
+
+
+class TradeAggregates:
+
+    """
+    Running totals of a trading, updated on every addition in O(1) per trade (O(symbols) per batch)
+        notional: sum of price * quantity per symbol
+        volume: sum of quantities per symbol
+        log_sum: sum of log(weighted price) over all symbols, for the geometric mean
+
+    Reading a weighted price or the geometric mean is O(1) whatever the size of the trading.
+
+    """
+
+    def __init__(self):
+        self.notional = {}
+        self.volume = {}
+        self.log_sum = 0.0
+        self.undefined = 0      # symbols without volume (no weighted price)
+        self.zeros = 0          # symbols without a positive weighted price (out of the log sum)
+
+    def _account(self, symbol, sign):   # puts (1) or takes out (-1) the symbol weighted price on the log sum
+        volume = self.volume[symbol]
+        if volume == 0:
+            self.undefined += sign
+            return
+        price = self.notional[symbol] / volume
+        if price > 0:
+            self.log_sum += sign * log(price)
+        else:
+            self.zeros += sign
+
+    def add(self, symbol, notional, volume):
+        if symbol in self.volume:
+            self._account(symbol, -1)
+            self.notional[symbol] += notional
+            self.volume[symbol] += volume
+        else:
+            self.notional[symbol] = notional
+            self.volume[symbol] = volume
+        self._account(symbol, 1)
+
+    def add_trade(self, trade):
+        self.add(trade.symbol, trade.price * trade.quantity, trade.quantity)
+
+    def add_trades(self, trades):   # totals the batch first, so every symbol is updated once
+        totals = {}
+        for trade in trades:
+            notional, volume = totals.get(trade.symbol, (0, 0))
+            totals[trade.symbol] = (notional + trade.price * trade.quantity, volume + trade.quantity)
+        for symbol, (notional, volume) in totals.items():
+            self.add(symbol, notional, volume)
+
+    def add_columns(self, columns, start=0):    # totals for the rows of a TradeColumns from start
+        codes = columns['symbol'][start:]
+        quantities = columns['quantity'][start:].astype(np.float64)
+        counts = np.bincount(codes, minlength=len(columns.stocks))
+        volumes = np.bincount(codes, weights=quantities, minlength=len(columns.stocks)).tolist()
+        notionals = np.bincount(codes, weights=columns['price'][start:] * quantities,
+                                minlength=len(columns.stocks)).tolist()
+        for code in np.flatnonzero(counts).tolist():
+            self.add(columns.stocks[code].symbol, notionals[code], volumes[code])
+
+    def copy(self):
+        aggregates = TradeAggregates()
+        aggregates.notional = self.notional.copy()
+        aggregates.volume = self.volume.copy()
+        aggregates.log_sum = self.log_sum
+        aggregates.undefined = self.undefined
+        aggregates.zeros = self.zeros
+        return aggregates
+
+    def weighted_price(self, symbol):
+        if symbol not in self.volume:
+            raise Exception('No objects on this query')
+        if self.volume[symbol] == 0:
+            raise Exception('Divide by 0!')
+        return self.notional[symbol] / self.volume[symbol]
+
+    def geometric_mean(self):
+        if not self.volume:
+            raise Exception('No objects on this query')
+        if self.undefined:
+            raise Exception('Divide by 0!')
+        if self.zeros:
+            return 0.0
+        return exp(self.log_sum / len(self.volume))
+
+
+class TradeWindow:
+
+    """
+    Volume Weighted Stock Prices over a sliding time window (for example the last 15 minutes).
+    Trades are summed up by time bucket in ring buffers, one row per symbol:
+        notional: sum of price * quantity per symbol and bucket
+        volume: sum of quantities per symbol and bucket
+        count: number of trades per symbol and bucket
+        epochs: bucket number (timestamp // width) held by every slot of the ring
+
+    A slot is reused, and its old bucket expires, as newer trades move the clock forward.
+    A weighted price costs O(buckets) whatever the number of trades recorded.
+    Resolution is one bucket: the bucket where the window starts is taken whole.
+
+    """
+
+    empty = np.iinfo(np.int64).min
+
+    def __init__(self, length, buckets=300):
+        self.length = length // timedelta(microseconds=1) * 1000    # window length in nanoseconds
+        self.width = max(-(-self.length // buckets), 1)            # bucket width in nanoseconds
+        self.slots = buckets + 1                                    # enough for a window starting mid bucket
+        self.rows = {}          # symbol -> row
+        self.notional = np.zeros((0, self.slots))
+        self.volume = np.zeros((0, self.slots))
+        self.count = np.zeros((0, self.slots), dtype=np.int64)
+        self.epochs = np.full(self.slots, self.empty, dtype=np.int64)
+
+    def _row(self, symbol):
+        row = self.rows.get(symbol)
+        if row is None:
+            row = self.rows[symbol] = len(self.rows)
+            if row == len(self.notional):   # capacity doubles
+                extra = max(row, 8)
+                self.notional = np.vstack([self.notional, np.zeros((extra, self.slots))])
+                self.volume = np.vstack([self.volume, np.zeros((extra, self.slots))])
+                self.count = np.vstack([self.count, np.zeros((extra, self.slots), dtype=np.int64)])
+        return row
+
+    def add_trade(self, trade):
+        epoch = trade.ns // self.width
+        slot = epoch % self.slots
+        if epoch < self.epochs[slot]:       # expired yet
+            return
+        row = self._row(trade.symbol)
+        if epoch > self.epochs[slot]:       # the slot moves on to a newer bucket
+            self.epochs[slot] = epoch
+            self.notional[:, slot] = 0
+            self.volume[:, slot] = 0
+            self.count[:, slot] = 0
+        self.notional[row, slot] += trade.price * trade.quantity
+        self.volume[row, slot] += trade.quantity
+        self.count[row, slot] += 1
+
+    def add_trades(self, trades):
+        rows = [self._row(x.symbol) for x in trades]
+        self._add(np.asarray(rows, dtype=np.intp),
+                  np.fromiter((x.ns for x in trades), dtype=np.int64, count=len(trades)),
+                  np.fromiter((x.quantity for x in trades), dtype=np.float64, count=len(trades)),
+                  np.fromiter((x.price for x in trades), dtype=np.float64, count=len(trades)))
+
+    def add_columns(self, columns, start=0):    # rows of a TradeColumns from start
+        lookup = np.asarray([self._row(x.symbol) for x in columns.stocks], dtype=np.intp)
+        self._add(lookup[columns['symbol'][start:]], columns['timestamp'][start:],
+                  columns['quantity'][start:].astype(np.float64), columns['price'][start:])
+
+    def _add(self, rows, timestamps, quantities, prices):
+        if not len(rows):
+            return
+        epochs = timestamps // self.width
+        slots = epochs % self.slots
+        newest = self.epochs.copy()         # newest bucket per slot after the batch
+        np.maximum.at(newest, slots, epochs)
+        moved = newest != self.epochs
+        self.notional[:, moved] = 0
+        self.volume[:, moved] = 0
+        self.count[:, moved] = 0
+        self.epochs = newest
+        live = epochs == newest[slots]      # the others expired by newer trades
+        rows, slots = rows[live], slots[live]
+        np.add.at(self.notional, (rows, slots), prices[live] * quantities[live])
+        np.add.at(self.volume, (rows, slots), quantities[live])
+        np.add.at(self.count, (rows, slots), 1)
+
+    def weighted_price(self, symbol, now):      # weighted price for trades between now - window and now
+        row = self.rows.get(symbol)
+        now = to_ns(now)
+        live = (self.epochs >= (now - self.length) // self.width) & (self.epochs <= now // self.width)
+        if row is None or not self.count[row, live].any():
+            raise Exception('No objects on this query')
+        volume = self.volume[row, live].sum()
+        if volume == 0:
+            raise Exception('Divide by 0!')
+        return float(self.notional[row, live].sum() / volume)
+
+
+class TradeBars:
+
+    """
+    Open, high, low, close, volume and VWAP bars per symbol, for bars of a width (for example 1 minute).
+    Every symbol keeps its bars in one compact structured array sorted by time (capacity doubles when full):
+        start: bar start, epoch nanoseconds (a multiple of the width)
+        open, high, low, close: prices. Open and close are the prices of the first and last trades in time
+        volume: sum of quantities
+        notional: sum of price * quantity (vwap is notional / volume)
+        count: number of trades
+        first, last: times of the first and last trades, to keep open and close right whatever the order
+
+    A trade updates the bar of its time in O(1): the last bar of the symbol (the current one), or a new bar
+    which closes the previous one. A late trade updates its finished bar (found by binary search).
+    Batches are summed up by symbol and bar first (vectorized), so every bar is updated once.
+    bars(symbol, start, end) reads a range of bars with two binary searches.
+
+    """
+
+    bar = np.dtype([('start', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+                    ('volume', '<i8'), ('notional', '<f8'), ('count', '<i8'), ('first', '<i8'), ('last', '<i8')])
+    result = np.dtype([('start', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+                       ('volume', '<i8'), ('vwap', '<f8'), ('count', '<i8')])
+    chunk = 16
+
+    def __init__(self, width):
+        self.width = width // timedelta(microseconds=1) * 1000      # bar width in nanoseconds
+        if self.width <= 0:
+            raise Exception('Bars need a positive width')
+        self.series = {}        # symbol -> [bars array, number of bars]
+
+    def add_trade(self, trade):
+        self._merge(trade.symbol, trade.ns // self.width * self.width, trade.price, trade.price, trade.price,
+                    trade.price, trade.quantity, trade.price * trade.quantity, 1, trade.ns, trade.ns)
+
+    def add_trades(self, trades):
+        symbols = list(dict.fromkeys(x.symbol for x in trades))
+        codes = {symbol: code for code, symbol in enumerate(symbols)}
+        self._add(symbols, np.fromiter((codes[x.symbol] for x in trades), dtype=np.intp, count=len(trades)),
+                  np.fromiter((x.ns for x in trades), dtype=np.int64, count=len(trades)),
+                  np.fromiter((x.quantity for x in trades), dtype=np.int64, count=len(trades)),
+                  np.fromiter((x.price for x in trades), dtype=np.float64, count=len(trades)))
+
+    def add_columns(self, columns, start=0):    # rows of a TradeColumns from start
+        self._add([x.symbol for x in columns.stocks], columns['symbol'][start:], columns['timestamp'][start:],
+                  columns['quantity'][start:], columns['price'][start:])
+
+    def _add(self, symbols, codes, timestamps, quantities, prices):     # one update per symbol and bar
+        if not len(codes):
+            return
+        starts = timestamps // self.width * self.width
+        order = np.lexsort((timestamps, starts, codes))     # stable: same time trades keep their order
+        codes, starts, timestamps = codes[order], starts[order], timestamps[order]
+        quantities, prices = quantities[order], prices[order]
+        first = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (starts[1:] != starts[:-1])])
+        last = np.r_[first[1:], len(codes)] - 1
+        groups = np.zeros(len(first), dtype=self.bar)      # the batch bars, by symbol and time
+        groups['start'], groups['open'], groups['close'] = starts[first], prices[first], prices[last]
+        groups['high'] = np.maximum.reduceat(prices, first)
+        groups['low'] = np.minimum.reduceat(prices, first)
+        groups['volume'] = np.add.reduceat(quantities, first)
+        groups['notional'] = np.add.reduceat(prices * quantities, first)
+        groups['count'] = last - first + 1
+        groups['first'], groups['last'] = timestamps[first], timestamps[last]
+        owners = codes[first]
+        bounds = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1], True])
+        for low, high in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            symbol = symbols[owners[low]]
+            series = self.series.get(symbol)
+            latest = series[0]['start'][series[1] - 1] if series and series[1] else np.iinfo(np.int64).min
+            while low < high and groups['start'][low] <= latest:      # into the current or finished bars
+                self._merge(symbol, *groups[low].tolist())
+                low += 1
+            self._append(symbol, groups[low:high])                  # new bars, all at once
+
+    def _append(self, symbol, bars):
+        series = self.series.get(symbol)
+        if series is None:
+            series = self.series[symbol] = [np.zeros(self.chunk, dtype=self.bar), 0]
+        number = series[1]
+        if number + len(bars) > len(series[0]):
+            capacity = len(series[0])
+            while capacity < number + len(bars):
+                capacity *= 2
+            series[0] = np.concatenate([series[0], np.zeros(capacity - len(series[0]), dtype=self.bar)])
+        series[0][number:number + len(bars)] = bars
+        series[1] = number + len(bars)
+
+    def _merge(self, symbol, start, open_price, high, low, close, volume, notional, count, first, last):
+        series = self.series.get(symbol)
+        if series is None:
+            series = self.series[symbol] = [np.zeros(self.chunk, dtype=self.bar), 0]
+        bars, number = series
+        if number and start <= bars['start'][number - 1]:
+            row = number - 1 if start == bars['start'][number - 1] \
+                else int(np.searchsorted(bars['start'][:number], start))
+            if bars['start'][row] == start:     # the current bar, or a finished one for a late trade
+                bar = bars[row]
+                if first < bar['first']:
+                    bar['open'], bar['first'] = open_price, first
+                if last >= bar['last']:
+                    bar['close'], bar['last'] = close, last
+                bar['high'] = max(bar['high'], high)
+                bar['low'] = min(bar['low'], low)
+                bar['volume'] += volume
+                bar['notional'] += notional
+                bar['count'] += count
+                return
+        else:
+            row = number
+        if number == len(bars):
+            bars = series[0] = np.concatenate([bars, np.zeros(len(bars), dtype=self.bar)])
+        bars[row + 1:number + 1] = bars[row:number]        # a gap filled by a late trade moves the later bars
+        bars[row] = (start, open_price, high, low, close, volume, notional, count, first, last)
+        series[1] = number + 1
+
+    def bars(self, symbol, start=None, end=None):   # bars starting from start (included) to end (excluded)
+        series = self.series.get(symbol)
+        if series is None:
+            return np.zeros(0, dtype=self.result)
+        bars, number = series
+        starts = bars['start'][:number]
+        low = 0 if start is None else int(np.searchsorted(starts, to_ns(start)))
+        high = number if end is None else int(np.searchsorted(starts, to_ns(end)))
+        picked = bars[low:high]
+        result = np.zeros(len(picked), dtype=self.result)
+        for field in ('start', 'open', 'high', 'low', 'close', 'volume', 'count'):
+            result[field] = picked[field]
+        result['vwap'] = picked['notional'] / np.where(picked['volume'] == 0, np.nan, picked['volume'])
+        return result
+
+
+class TradeIndex:
+
+    """
+    Indexes of a trading over row positions (position in the trading list or row in the columns)
+        symbols: hash index. Symbol -> positions of its trades in order of addition
+        versions: per symbol version counters, bumped by every trade of the symbol added
+        ordered: (keys, rows): timestamps (epoch nanoseconds) sorted and their positions, for bisect lookups on
+                 time. Replaced as a whole, so readers always get a consistent pair
+        times: timestamps (epoch nanoseconds) by position, for vectorized time filters and ordering
+
+    Additions only append their timestamps, and are merged lazily on the next time lookup. Trades coming in
+    time order are just appended to the sorted run; out of order ones are merged with a stable sort.
+    Trades added one by one are buffered by symbol (growable int64 arrays) and become a chunk on lookup, so
+    a single addition is O(1) and takes 16 bytes.
+    Lazy merges hold a lock and publish their result before marking the positions merged, so many threads
+    can query the same trading at once and the ones finding nothing to merge take no lock.
+    Positions only grow, so tradings sharing the index see just their own trades passing their size to lookups.
+
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.symbols = {}       # symbol -> list of position chunks, joined on lookup
+        self.buffers = {}       # symbol -> positions of the trades added one by one, not a chunk yet
+        self.versions = {}      # symbol -> version: trades of the symbol added
+        self.ordered = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.intp))
+        self.merged = 0         # positions in keys / rows. The ones after are merged on the next time lookup
+        self.times = np.empty(TradeColumns.chunk, dtype=np.int64)    # capacity doubles when full
+        self.lock = threading.Lock()
+
+    def add(self, codes, names, timestamps):    # codes: symbol code per trade, names: code -> symbol
+        with self.lock:
+            self._add(codes, names, timestamps)
+
+    def _reserve(self, number):
+        if self.size + number > len(self.times):
+            times = np.empty(max(2 * len(self.times), self.size + number), dtype=np.int64)
+            times[:self.size] = self.times[:self.size]
+            self.times = times
+
+    def _add(self, codes, names, timestamps):
+        if len(codes) == 1:
+            return self._append(names[codes[0]], timestamps[0])
+        positions = np.arange(self.size, self.size + len(codes))
+        self._reserve(len(codes))
+        self.times[self.size:self.size + len(codes)] = timestamps
+        self.size += len(codes)
+        if not len(codes):
+            return
+        order = np.argsort(codes, kind='stable')
+        groups, starts = np.unique(codes[order], return_index=True)
+        for code, chunk in zip(groups.tolist(), np.split(positions[order], starts[1:])):
+            chunks = self.symbols.setdefault(names[code], [])
+            self._flush(names[code], chunks)        # positions stay in order of addition
+            chunks.append(chunk)
+            self.versions[names[code]] = self.versions.get(names[code], 0) + len(chunk)
+
+    def _append(self, symbol, timestamp):      # a single trade: no arrays built
+        self._reserve(1)
+        self.times[self.size] = timestamp
+        buffer = self.buffers.get(symbol)
+        if buffer is None:
+            buffer = self.buffers[symbol] = array('q')
+            self.symbols.setdefault(symbol, [])
+        buffer.append(self.size)
+        self.versions[symbol] = self.versions.get(symbol, 0) + 1
+        self.size += 1
+
+    def _flush(self, symbol, chunks):       # the buffered positions of a symbol as one more chunk
+        buffer = self.buffers.get(symbol)
+        if buffer:
+            chunks.append(np.array(buffer, dtype=np.intp))
+            del buffer[:]
+
+    def add_trade(self, trade):
+        with self.lock:
+            self._append(trade.symbol, trade.ns)
+
+    def add_trades(self, trades):
+        names = {}
+        codes = np.fromiter((names.setdefault(x.symbol, len(names)) for x in trades), dtype=np.intp, count=len(trades))
+        self.add(codes, list(names), [x.ns for x in trades])
+
+    def add_columns(self, columns, start=0):
+        self.add(columns['symbol'][start:], [x.symbol for x in columns.stocks], columns['timestamp'][start:])
+
+    def timestamps(self):       # timestamps by position
+        return self.times[:self.size]
+
+    def version(self, symbol, size):    # version of a symbol for a trading of some size: its trades below size
+        if size >= self.size:
+            return self.versions.get(symbol, 0)
+        return len(self.symbol(symbol, size))
+
+    def symbol(self, symbol, size=None):    # positions of a symbol trades (below size)
+        chunks = self.symbols.get(symbol)
+        if chunks is None:
+            return np.empty(0, dtype=np.intp)
+        if len(chunks) != 1 or self.buffers.get(symbol):
+            with self.lock:
+                self._flush(symbol, chunks)
+                if len(chunks) > 1:
+                    chunks[:] = [np.concatenate(chunks)]
+        if not chunks:
+            return np.empty(0, dtype=np.intp)
+        positions = chunks[0]
+        if size is not None and size < self.size:
+            positions = positions[:np.searchsorted(positions, size)]
+        return positions
+
+    def _merge(self):
+        if self.merged == self.size:
+            return
+        with self.lock:
+            if self.merged < self.size:
+                self._merge_pending()
+
+    def _merge_pending(self):       # the positions added since the last merge, already in the times array
+        size = self.size
+        keys = self.times[self.merged:size].copy()
+        rows = np.arange(self.merged, size)
+        merged_keys, merged_rows = self.ordered
+        if (np.diff(keys) >= 0).all() and (not len(merged_keys) or keys[0] >= merged_keys[-1]):
+            self.ordered = (np.concatenate([merged_keys, keys]),       # in time order: just appended
+                            np.concatenate([merged_rows, rows]))
+        else:
+            keys = np.concatenate([merged_keys, keys])
+            order = np.argsort(keys, kind='stable')                     # merges sorted runs
+            self.ordered = (keys[order], np.concatenate([merged_rows, rows])[order])
+        self.merged = size      # only now: readers skipping the lock find the new arrays
+
+    def by_time(self, size=None):       # all positions (below size) in timestamp order
+        self._merge()
+        rows = self.ordered[1]
+        if size is not None and size < self.size:
+            return rows[rows < size]
+        return rows
+
+    def between(self, low=None, high=None, size=None):  # positions with low <= timestamp <= high, in order of addition
+        self._merge()
+        keys, rows = self.ordered
+        start = 0 if low is None else np.searchsorted(keys, low, side='left')
+        end = len(keys) if high is None else np.searchsorted(keys, high, side='right')
+        rows = rows[start:end]
+        if size is not None and size < self.size:
+            rows = rows[rows < size]
+        return np.sort(rows)
+
+
+class TradeCache:
+
+    """
+    Bounded LRU cache for calculations of a trading and its views (tradings sharing the trades)
+    Results are kept by calculation, query steps, arguments and version:
+        weighted_price(symbol): the version of the symbol (TradeIndex), so adding trades of other symbols
+                                keeps it
+        stock_index, geometric_mean: the size of the trading
+
+    cache.get(key, calculate): the result kept or calculate() (kept then). The least recently used result
+                               goes when there are more than size
+    cache.stats(): hits, misses, results kept and size
+
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, calculate):
+        try:
+            with self.lock:
+                result = self.results[key]
+                self.results.move_to_end(key)
+                self.hits += 1
+                return result
+        except KeyError:
+            pass
+        except TypeError:       # unhashable query values: not kept
+            return calculate()
+        result = calculate()
+        with self.lock:
+            self.misses += 1
+            self.results[key] = result
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+        return result
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'results': len(self.results), 'size': self.size}
+
+
+class TradeMetrics:
+
+    """
+    Opt-in instrumentation of the trading operations. Disabled (the default) every operation only checks a flag
+        METRICS.enable() / METRICS.disable() / METRICS.reset()
+        METRICS.record(operation, seconds, rows_in, rows_out): rows are left out if not given
+
+    Per operation: calls, total seconds, a latency histogram (seconds buckets) and rows in and out
+        filter, exclude, before, after, order_by: calls and latency only (no rows), they just record a query
+                                                  step. Their rows are in the query phases below
+        query.candidates: trades picked from the indexes (rows in: trades of the trading)
+        query.filter: fused filters and time ranges over the candidates
+        query.order_by: orderings over the filtered trades
+        to_list, first, get_symbols, weighted_price, bars, stock_index, geometric_mean: whole calls, the query
+                                                                                     run included
+
+    METRICS.as_dict(): {operation: {'count', 'seconds', 'histogram': {bucket: calls}, 'rows_in', 'rows_out'}}
+                       with cumulative histograms ('+Inf' for all of them). Rows only for operations with rows
+    METRICS.prometheus(): the same in the Prometheus text exposition format, one metric family after another
+    @METRICS: decorator for trading methods
+
+    """
+
+    buckets = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def record(self, operation, seconds, rows_in=None, rows_out=None):
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = [0, 0.0, None, None, [0] * (len(self.buckets) + 1)]
+            stats[0] += 1
+            stats[1] += seconds
+            if rows_in is not None:
+                stats[2] = (stats[2] or 0) + rows_in
+                stats[3] = (stats[3] or 0) + rows_out
+            stats[4][bisect_left(self.buckets, seconds)] += 1
+
+    def __call__(self, func):       # times a trading method: rows in are the trades of the trading
+        @functools.wraps(func)
+        def wrap(inst, *args, **kwargs):
+            if not self.enabled:
+                return func(inst, *args, **kwargs)
+            started = time.perf_counter()
+            result = func(inst, *args, **kwargs)
+            self.record(func.__name__, time.perf_counter() - started, inst.size,
+                        len(result) if isinstance(result, (list, np.ndarray)) else 1)
+            return result
+
+        return wrap
+
+    def as_dict(self):
+        with self.lock:
+            operations = {x: (y[0], y[1], y[2], y[3], list(y[4])) for x, y in self.operations.items()}
+        metrics = {}
+        for operation, (count, seconds, rows_in, rows_out, buckets) in sorted(operations.items()):
+            cumulative = np.cumsum(buckets).tolist()
+            histogram = dict(zip([str(x) for x in self.buckets] + ['+Inf'], cumulative))
+            metrics[operation] = {'count': count, 'seconds': seconds, 'histogram': histogram}
+            if rows_in is not None:
+                metrics[operation].update(rows_in=rows_in, rows_out=rows_out)
+        return metrics
+
+    def prometheus(self, prefix='trading'):
+        metrics = self.as_dict()
+        name = '{}_operation_seconds'.format(prefix)
+        lines = ['# TYPE {} histogram'.format(name)]
+        for operation, stats in metrics.items():
+            label = 'operation="{}"'.format(operation)
+            for bucket, calls in stats['histogram'].items():
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, bucket, calls))
+            lines.append('{}_sum{{{}}} {!r}'.format(name, label, stats['seconds']))
+            lines.append('{}_count{{{}}} {}'.format(name, label, stats['count']))
+        for rows in ('rows_in', 'rows_out'):
+            name = '{}_operation_{}_total'.format(prefix, rows)
+            lines.append('# TYPE {} counter'.format(name))
+            lines.extend('{}{{operation="{}"}} {}'.format(name, operation, stats[rows])
+                         for operation, stats in metrics.items() if rows in stats)
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = TradeMetrics()
+
+
+class TradingQuery:
+
+    """
+    A lazy query over a trading. Filters, time filters and orderings are only recorded as steps and run
+    all together when trades are asked for (to_list, first):
+        - symbol or stock equality (or in) and time ranges pick the candidate trades from the indexes
+        - the other filters run fused: one vectorized mask (columnar) or one single pass (list)
+        - orderings are applied at the end, over the filtered trades only
+    first() with no ordering stops at the first chunk with a match.
+    A query is immutable. Adding a step returns a new query.
+
+    Filters take lookups after the attribute name (attribute__lookup=value), equality when there is none:
+        gt, gte, lt, lte: quantity, price and timestamp comparisons        price__gt=200
+        between: inclusive range (low, high)                                quantity__between=(100, 1000)
+        in: any of some values                                              symbol__in=['POP', 'GIN']
+    Time filters (timestamp filters too) use the time index. symbol__in and stock__in use the symbol index.
+
+    """
+
+    chunk = 4096
+    lookups = {'exact': operator.eq, 'gt': operator.gt, 'gte': operator.ge, 'lt': operator.lt, 'lte': operator.le,
+               'between': lambda x, y: y[0] <= x <= y[1], 'in': lambda x, y: x in y}
+    ranges = ('quantity', 'price', 'timestamp')     # attributes with comparisons
+
+    def __init__(self, steps=()):
+        self.steps = steps
+
+    def add(self, *step):
+        return TradingQuery(self.steps + (step,))
+
+    @classmethod
+    def predicate(cls, key, value):     # checks a filter argument. Returns (attribute, value, lookup)
+        attribute, _, lookup = key.partition('__')
+        lookup = lookup or 'exact'
+        if attribute not in TradeColumns.attributes:
+            raise Exception('{} attribute doesn\'t exist'.format(attribute))
+        if lookup not in cls.lookups:
+            raise Exception('{} lookup doesn\'t exist'.format(lookup))
+        if lookup not in ('exact', 'in') and attribute not in cls.ranges:
+            raise Exception('{} lookup doesn\'t apply to {}'.format(lookup, attribute))
+        values = None
+        if lookup in ('in', 'between'):
+            if isinstance(value, (str, bytes)) or not hasattr(value, '__iter__'):
+                raise Exception('{} needs a list of values'.format(key))
+            values = tuple(value)
+            if lookup == 'between' and len(values) != 2:
+                raise Exception('{} needs two values: (low, high)'.format(key))
+        if attribute == 'timestamp':       # times as epoch nanoseconds
+            try:
+                values = tuple(to_ns(x) for x in values) if values is not None else None
+                value = to_ns(value) if values is None else value
+            except Exception:
+                raise Exception("Time stamp is not in ISO format: YYYY-MM-DDTHH:MM:SS.mmmm")
+        return attribute, value if values is None else values, lookup
+
+    def _compile(self):
+        predicates = []     # (attribute, value, keep, lookup). keep: filter (True) or exclude (False)
+        low = high = None   # time range in epoch nanoseconds
+        orderings = []      # (attribute, reverse)
+        for step in self.steps:
+            if step[0] == 'filter' and step[1] == 'timestamp' and step[3] != 'in':     # time range on the index
+                first, last = step[2] if step[3] == 'between' else (step[2], step[2])
+                if step[3] in ('gt', 'gte', 'lt', 'lte'):      # integer nanoseconds: open bounds are one apart
+                    first, last = {'gt': (first + 1, None), 'gte': (first, None),
+                                   'lt': (None, last - 1), 'lte': (None, last)}[step[3]]
+                low = first if low is None else low if first is None else max(low, first)
+                high = last if high is None else high if last is None else min(high, last)
+            elif step[0] in ('filter', 'exclude'):
+                predicates.append((step[1], step[2], step[0] == 'filter', step[3]))
+            elif step[0] == 'after':
+                low = step[1] if low is None else max(low, step[1])
+            elif step[0] == 'before':
+                high = step[1] if high is None else min(high, step[1])
+            else:
+                orderings.append((step[1], step[2]))
+        return predicates, low, high, orderings
+
+    def _candidates(self, trading, predicates, low, high, orderings):   # positions to check from the indexes
+        candidates = None
+        rest = []
+        for attribute, value, keep, lookup in predicates:
+            if keep and attribute in ('symbol', 'stock'):
+                if lookup == 'exact':
+                    positions = trading._symbol_positions(attribute, value)
+                else:       # positions of every symbol, in order
+                    positions = np.unique(np.concatenate([np.empty(0, dtype=np.intp)] +
+                                                         [trading._symbol_positions(attribute, x) for x in value]))
+                candidates = positions if candidates is None else np.intersect1d(candidates, positions)
+            else:
+                rest.append((attribute, value, keep, lookup))
+        if candidates is None:
+            if low is not None or high is not None:
+                return trading.index.between(low, high, trading.size), rest, None, None, orderings
+            if not rest and orderings[:1] == [('timestamp', False)]:
+                return trading.index.by_time(trading.size), rest, low, high, orderings[1:]
+            candidates = np.arange(trading.size)
+        return candidates, rest, low, high, orderings
+
+    @staticmethod
+    def _filter(trading, positions, predicates, low, high):     # fused filter over some positions
+        if low is not None or high is not None:
+            times = trading.index.timestamps()[positions]
+            mask = np.ones(len(positions), dtype=bool)
+            if low is not None:
+                mask &= times >= low
+            if high is not None:
+                mask &= times <= high
+            positions = positions[mask]
+        if not predicates:
+            return positions
+        if trading.columns is not None:
+            mask = np.ones(len(positions), dtype=bool)
+            for attribute, value, keep, lookup in predicates:
+                column = trading.columns.column(attribute)[positions]
+                if lookup in ('in', 'between'):
+                    value = tuple(trading.columns.encode(attribute, x) for x in value)
+                else:
+                    value = trading.columns.encode(attribute, value)
+                mask &= TradingQuery._mask(column, value, lookup) == keep
+            return positions[mask]
+        times = [x for x in predicates if x[0] == 'timestamp']     # integer comparisons on the packed times
+        if times:
+            stamps = trading.index.timestamps()[positions]
+            mask = np.ones(len(positions), dtype=bool)
+            for attribute, value, keep, lookup in times:
+                mask &= TradingQuery._mask(stamps, value, lookup) == keep
+            positions = positions[mask]
+            predicates = [x for x in predicates if x[0] != 'timestamp']
+        trades = trading.trading_list
+        tests = [(attribute, TradingQuery.lookups[lookup], value, keep)
+                 for attribute, value, keep, lookup in predicates]
+        return np.asarray([x for x in positions.tolist()
+                           if all(test(getattr(trades[x], attribute), value) == keep
+                                  for attribute, test, value, keep in tests)], dtype=np.intp)
+
+    @staticmethod
+    def _mask(column, value, lookup):   # vectorized lookup over a column
+        if lookup == 'in':
+            return np.isin(column, np.asarray(value))      # no cast to the column type: 100.5 never is 100
+        if lookup == 'between':
+            return (column >= value[0]) & (column <= value[1])
+        return TradingQuery.lookups[lookup](column, value)
+
+    @staticmethod
+    def _order(trading, positions, attribute, reverse):     # stable as list.sort: equal keys keep their order
+        if trading.columns is None and attribute != 'timestamp':
+            trades = trading.trading_list
+            return np.asarray(sorted(positions.tolist(), key=lambda x: getattr(trades[x], attribute),
+                                     reverse=reverse), dtype=np.intp)
+        if attribute == 'timestamp':
+            keys = trading.index.timestamps()[positions]
+        else:
+            keys = trading.columns.sort_key(attribute)[positions]
+        if reverse:
+            return positions[::-1][np.argsort(keys[::-1], kind='stable')][::-1]
+        return positions[np.argsort(keys, kind='stable')]
+
+    def rows(self, trading):    # positions of the resulting trades, in order
+        if METRICS.enabled:
+            return self._measured_rows(trading)
+        positions, predicates, low, high, orderings = self._candidates(trading, *self._compile())
+        positions = self._filter(trading, positions, predicates, low, high)
+        for attribute, reverse in orderings:
+            positions = self._order(trading, positions, attribute, reverse)
+        return positions
+
+    def _measured_rows(self, trading):      # rows() recording every phase (TradeMetrics)
+        started = time.perf_counter()
+        positions, predicates, low, high, orderings = self._candidates(trading, *self._compile())
+        filtered = time.perf_counter()
+        METRICS.record('query.candidates', filtered - started, trading.size, len(positions))
+        rows = len(positions)
+        positions = self._filter(trading, positions, predicates, low, high)
+        ordered = time.perf_counter()
+        METRICS.record('query.filter', ordered - filtered, rows, len(positions))
+        for attribute, reverse in orderings:
+            positions = self._order(trading, positions, attribute, reverse)
+        if orderings:
+            METRICS.record('query.order_by', time.perf_counter() - ordered, len(positions), len(positions))
+        return positions
+
+    def first(self, trading):   # position of the first resulting trade
+        positions, predicates, low, high, orderings = self._candidates(trading, *self._compile())
+        if orderings:
+            positions = self.rows(trading)
+        else:
+            for start in range(0, len(positions), self.chunk):
+                found = self._filter(trading, positions[start:start + self.chunk], predicates, low, high)
+                if len(found):
+                    return found[0]
+            positions = []
+        if not len(positions):
+            raise Exception('No objects on this query')
+        return positions[0]
+
 
 class TradingFilter:
     """
-    This class is a decorator for checking if exists a filter list.
-    If don't, creates it from the trading list
-    Checks attributes and formats.
-        clean: for cleaning up the list after applying a filter ('to_list' and 'first')
-        time : checks time format in 'before' and 'after' filters
+    This class is a decorator for filters. Filters return a new view of the trading with one more step
+    on its query (TradingQuery), so the trading itself never changes.
+    Checks attributes, lookups and formats (TradingQuery.predicate).
+        time : checks time format in 'before' and 'after' filters and turns it into epoch nanoseconds
+    Calls are recorded by METRICS when enabled.
     """
-    def __init__(self, clean=False, time=False):
-        self.clean = clean
+    def __init__(self, time=False):
         self.time = time
 
     def __call__(self, func):
+        @functools.wraps(func)
         def wrap(inst, *args, **kwargs):
-            if inst.filter_list is None:
-                inst.filter_list = inst.trading_list.copy()
-            for key in kwargs:                                      # checks key arguments for filters
-                if not hasattr(inst.filter_list[0], key):
-                    raise Exception('{} attribute doesn\'t exist'.format(key))
-            if self.time:                                           # checks time if is a positional argument
+            kwargs = {key: TradingQuery.predicate(key, value) for key, value in kwargs.items()}     # checked filters
+            if self.time:                                           # time as epoch nanoseconds if is a positional argument
                 try:
-                    datetime.strftime(args[0], '%Y-%m%dT%H:%M:%S.%f')
+                    args = (to_ns(args[0]),) + args[1:]
                 except Exception:
                     raise Exception("Time stamp is not in ISO format: YYYY-MM-DDTHH:MM:SS.mmmm")
-            else:
-                pass
 
-            result = func(inst, *args, **kwargs)
-            if self.clean:                      # cleans for ending the filter (to_list and first)
-                inst.filter_list = None
-            return result
+            if METRICS.enabled:                                     # calls and latency (TradeMetrics)
+                started = time.perf_counter()
+                view = func(inst, *args, **kwargs)
+                METRICS.record(func.__name__, time.perf_counter() - started)     # rows: query phases
+                return view
+            return func(inst, *args, **kwargs)
 
         return wrap
 
@@ -173,6 +1529,8 @@ class Trading:    # A list of trades all together
                 trading.filter().to_list() : will return a list with all trades inside the trading
                 trading.filter(symbol='POP').to_list(): will return a list with all trades for this stock
                 trading.filter(symbol='POP', op='sell').to_list() will return a list with all sell operations from this stock
+                trading.filter(symbol__in=['POP', 'GIN'], price__gt=200, quantity__between=(100, 1000)).to_list():
+                    lookups after the attribute name: gt, gte, lt, lte, between and in (TradingQuery)
         exclude: as filter but excluding by criteria
         before: gets all trades before a time
         after: gets all trades after a time
@@ -181,6 +1539,8 @@ class Trading:    # A list of trades all together
         first: returns first trade from the trading list or filtered list (Trade type)
         get_symbols: gets all different stock symbols
         weighted_price: calculates the Volume Weighted Stock Price for a given symbol
+            weighted_price('POP', window=timedelta(minutes=15)) gets it for the last 15 minutes trades
+        stock_index: weighted price for every symbol and the geometric mean, computed together in one pass
         geometric_mean:  geometric mean for whole trading
 
         It is possible to chain filters. Next example gets buy operations from POP symbol last 5 minutes
@@ -191,68 +1551,371 @@ class Trading:    # A list of trades all together
             new_trading = Trading(list_of_trades) + Trade(single_trade_params)
             new_trading = Trading(list_of_trades) + list_of_trades
             new_trading = Trading(list_of_trades) + Trading(list_of_trades)
+            trading += Trade(single_trade_params)       (in place)
+
+        Adding never copies the trades: the new trading shares its storage (trade list or columns and indexes)
+        with the old one, and both keep seeing their own trades. The old one keeps its windows, bars and
+        journal. The cost is the trades added. Appending to an old trading which is not the latest one copies
+        its storage first.
+
+        Bulk loading: Trading.from_csv(path, stocks) reads trades (symbol, op, quantity, price, timestamp columns)
+        in chunks straight into arrays. Symbols are resolved through the stocks registry ({symbol: Stock}, as
+        loaded by Stock.from_csv) and every column is checked at once.
+        Trading.from_arrays(symbols, quantities, ops, prices, timestamps) does the same from lists or arrays.
+        Trades built from checked columns skip the Trade checks.
+
+        Weighted prices and the geometric mean are read from running totals (TradeAggregates) kept up to date
+        on every addition, so they are O(1) however big the trading is.
+        Weighted prices over a time window come from time bucketed ring buffers (TradeWindow). A window is
+        built from the trading the first time is asked for and then kept up to date on every addition.
+        bars(symbol, width=timedelta(minutes=1)) gives open, high, low, close, volume and VWAP bars (TradeBars),
+        also built the first time they are asked for a width and then kept up to date.
+        aggregate(by=['symbol', 'op', timedelta(minutes=5)], metrics=['count', 'volume', 'vwap', 'imbalance'])
+        groups the trades (of a view too) in one vectorized pass and returns a compact table.
+
+        Trades are indexed by symbol and by timestamp (TradeIndex).
+        Chained filters are lazy (TradingQuery): they are recorded and only run, all fused in one pass and using
+        the indexes, by to_list() or first().
+        Every filter returns a new view: a Trading sharing the trades with its own query. Views never change
+        the trading they come from, so one trading can serve many threads and abandoned chains are harmless.
+        Calculations on a view (weighted_price, stock_index, geometric_mean, get_symbols) use its trades only.
+        Their results are kept in a cache shared by the tradings over the same trades (TradeCache), until
+        trades of their symbols (weighted_price) or any trades (stock_index, geometric_mean) are added.
 
+        Columnar trading: Trading(list_of_trades, columnar=True) keeps the trades in numpy arrays (TradeColumns)
+        instead of a list of Trade objects. Same operations, but filters, time filters, ordering and calculations
+        run as vectorized masks and argsorts. Trade objects are only built by to_list() and first().
+
+        Journal: trading.record(path) writes the trades to an append-only binary journal (TradeJournal) and
+        then every trade added. Trading.from_journal(path, stocks) gets a columnar trading straight over the
+        journal file mapped in memory, so a restarted process serves queries without loading the trades.
+        Snapshot: trading.save(path) saves the trades and their stocks as compact columns (TradeSnapshot) and
+        TradeSnapshot.load(path) gives them back as (trading, {symbol: Stock}).
+        Feeding: TradeGateway(trading, stocks) receives trades from producers over a socket and adds them in bulk.
+        Sharding: ShardedTrading(stocks, shards) splits the trades by symbol across worker processes, with the
+        same queries.
+        Instrumentation: METRICS.enable() records calls, latency histograms and rows in and out of filters,
+        query phases and calculations (TradeMetrics), as a dict or Prometheus text.
+        Shared memory: TradePublisher(trading) publishes the trades in shared memory and TradeReader(name), in any
+        process, gets them as a columnar trading over the shared columns.
 
     """
 
-    def __init__(self, trading_list=None):  # you can create a void trade or a new one from a lits of trades
+    cache_size = 1024       # results kept by the cache (TradeCache) of a trading and its views
+    aggregations = {'count': '<i8', 'volume': '<i8', 'notional': '<f8', 'vwap': '<f8', 'buy_volume': '<i8',
+                    'sell_volume': '<i8', 'imbalance': '<f8'}     # aggregate() metrics and their types
+
+    def __init__(self, trading_list=None, columnar=False):  # you can create a void trade or a new one from a lits of trades
         self.trading_list = list()
+        self.columns = TradeColumns() if columnar else None
+        self.aggregates = TradeAggregates()
+        self.windows = {}       # window length (timedelta) -> TradeWindow
+        self.candles = {}       # bar width (timedelta) -> TradeBars
+        self.index = TradeIndex()
+        self.size = 0           # number of trades. The storage shared with other tradings may hold more
+        self.tip = [0]          # number of trades in the shared storage. Only a trading this size appends in place
+        self.query = TradingQuery()
+        self.journal = None     # TradeJournal written with every trade added
+        self.cache = TradeCache(self.cache_size)
         if trading_list:
-            for trade in trading_list:
-                if type(trade) != Trade:
-                    raise Exception("No valid list. All elements must belong to Trade class")
-            self.trading_list += trading_list
-        self.filter_list = None
-
-    def __add__(self, other):
-        trading_list = self.trading_list.copy()
-        trading = Trading(trading_list)
-        if type(other) == Trade:
-            trading._add_trade(other)
-        elif type(other) == list:
-            trading._add_tradelist(other)
-        elif type(other) == Trading:
-            trading._add_tradelist(other.to_list())
+            if set(map(type, trading_list)) != {Trade}:     # one pass at C speed
+                raise Exception("No valid list. All elements must belong to Trade class")
+            self._add_tradelist(trading_list)
+
+    def _share(self):       # a new trading over the same storage. Only running totals are copied (O(symbols))
+        trading = Trading.__new__(Trading)      # this one is left as it was: windows, bars and journal stay here
+        trading.__dict__.update(self.__dict__)
+        if self.columns is not None:
+            trading.columns = self.columns.share()
+        trading.aggregates = self.aggregates.copy()
+        trading.windows = {}        # built for the new trading when asked for
+        trading.candles = {}
+        trading.journal = None
+        trading.query = TradingQuery()
+        return trading
+
+    def _view(self, query):     # a trading sharing the trades with its own query
+        view = Trading.__new__(Trading)
+        view.__dict__.update(self.__dict__)
+        if self.columns is not None:
+            view.columns = self.columns.share()
+        view.aggregates = None      # views calculate over their own trades
+        view.windows = None
+        view.candles = None
+        view.journal = None
+        view.query = query
+        return view
+
+    def _own(self):     # before appending. A trading behind the tip of the shared storage gets its own copy
+        if self.size == self.tip[0]:
+            return
+        self.index = TradeIndex()
+        self.cache = TradeCache(self.cache.size)    # versions of other trades from now on
+        if self.columns is not None:
+            self.columns = self.columns.copy()
+            self.index.add_columns(self.columns)
         else:
-            raise Exception('Object must be Trade, a Trading or a list of Trade objects')
+            self.trading_list = self.trading_list[:self.size]
+            self.index.add_trades(self.trading_list)
+        self.tip = [self.size]
 
+    def _grown(self, number):
+        self.size += number
+        self.tip[0] = self.size
+
+    def __add__(self, other):   # new trading sharing the storage: O(trades added), this one is left as it was
+        if self.aggregates is None:     # a view adds its own trades only
+            trading = Trading(self.to_list(), columnar=self.columns is not None)
+        else:
+            trading = self._share()
+        trading._add(other)
         return trading
 
     def __radd__(self, other):
         return self + other
 
+    def __iadd__(self, other):  # adds in place
+        if self.aggregates is None:
+            return self + other
+        self._add(other)
+        return self
+
+    def _add(self, other):
+        if type(other) == Trade:
+            self._add_trade(other)
+        elif type(other) == list:
+            self._add_tradelist(other)
+        elif type(other) == Trading:
+            if other.columns is not None and not other.query.steps:     # straight from its columns
+                columns = other.columns
+                self._add_arrays(columns.stocks, columns['symbol'], columns['op'], columns['quantity'],
+                                 columns['price'], columns['timestamp'])
+            else:
+                self._add_tradelist(other.to_list())
+        else:
+            raise Exception('Object must be Trade, a Trading or a list of Trade objects')
+
     def _add_trade(self, trade):     # for adding a trade to the trading
         if type(trade) != Trade:
             raise Exception('Must be a Trade object')
-        self.trading_list.append(trade)
+        if self.journal:    # recorded first: a failed write leaves the trading as it was
+            self.journal.write_trade(trade)
+        self._own()
+        if self.columns is not None:
+            self.columns.append(trade)
+        else:
+            self.trading_list.append(trade)
+        self._grown(1)
+        self.aggregates.add_trade(trade)
+        self.index.add_trade(trade)
+        for window in self.windows.values():
+            window.add_trade(trade)
+        for bars in self.candles.values():
+            bars.add_trade(trade)
 
     def _add_tradelist(self, trades):
-        for trade in trades:
-            if type(trade) != Trade:
-                raise Exception('All objects should be Trade type')
-        self.trading_list.extend(trades)
+        if trades and set(map(type, trades)) != {Trade}:
+            raise Exception('All objects should be Trade type')
+        if self.journal:
+            self.journal.write_trades(trades)
+        self._own()
+        if self.columns is not None:
+            start = len(self.columns)
+            self.columns.extend(trades)
+            self._grown(len(trades))
+            self._added_columns(start)
+        else:
+            self.trading_list.extend(trades)
+            self._grown(len(trades))
+            self._added_trades(trades)
+
+    def _add_arrays(self, stocks, codes, ops, quantities, prices, timestamps):  # columns checked yet (_check_arrays)
+        if self.journal:
+            self.journal.write_arrays(stocks, codes, ops, quantities, prices, timestamps)
+        self._own()
+        if self.columns is not None:
+            start = len(self.columns)
+            self.columns.extend_arrays(stocks, codes, ops, quantities, prices, timestamps)
+            self._grown(len(codes))
+            self._added_columns(start)
+        else:
+            trades = [Trade._restore(stocks[code], quantity, TradeColumns.ops[op], price, timestamp)
+                      for code, op, quantity, price, timestamp in zip(codes.tolist(), ops.tolist(),
+                                                                      quantities.tolist(), prices.tolist(),
+                                                                      timestamps.tolist())]
+            self.trading_list.extend(trades)
+            self._grown(len(trades))
+            self._added_trades(trades)
+
+    def _added_columns(self, start):    # keeps running totals and indexes up to date with the new rows
+        self.aggregates.add_columns(self.columns, start)
+        self.index.add_columns(self.columns, start)
+        for window in self.windows.values():
+            window.add_columns(self.columns, start)
+        for bars in self.candles.values():
+            bars.add_columns(self.columns, start)
+
+    def _added_trades(self, trades):
+        self.aggregates.add_trades(trades)
+        self.index.add_trades(trades)
+        for window in self.windows.values():
+            window.add_trades(trades)
+        for bars in self.candles.values():
+            bars.add_trades(trades)
+
+    def record(self, journal, sync=False):     # writes the trades and then every trade added to a journal
+        if self.aggregates is None:
+            raise Exception('A filtered trading can not be recorded')
+        journal = journal if isinstance(journal, TradeJournal) else TradeJournal(journal, sync=sync)
+        if self.columns is not None:
+            journal.write_columns(self.columns)
+        else:
+            journal.write_trades(self.trading_list[:self.size])
+        self.journal = journal
+        return journal
+
+    def save(self, path, compress=False):      # snapshot of the trades and their stocks (TradeSnapshot)
+        TradeSnapshot.save(self, path, compress)
+
+    @classmethod
+    def from_journal(cls, path, stocks, append=False, sync=False):
+        # columnar trading over a journal file mapped in memory (read only): trades are read, not loaded
+        # stocks: registry ({symbol: Stock}) or list of stocks. append: trades added go on to the journal
+        trading = cls(columnar=True)
+        trading.columns = TradeJournal.columns(path, stocks)
+        trading._grown(len(trading.columns))
+        trading._added_columns(0)
+        if append:
+            trading.journal = TradeJournal(path, sync=sync)
+        return trading
+
+    @classmethod
+    def from_arrays(cls, symbols, quantities, ops, prices, timestamps=None, stocks=None, columnar=True):
+        # builds a trading from whole columns (lists or arrays), checked at once instead of trade by trade
+        # symbols: Stock objects or symbols found in stocks (registry {symbol: Stock} or list of stocks)
+        # timestamps: datetimes, ISO strings, datetime64 or epoch nanoseconds. Time now if None
+        registry = stocks if isinstance(stocks, dict) or stocks is None else {x.symbol: x for x in stocks}
+        trading = cls(columnar=columnar)
+        trading._add_arrays(*cls._check_arrays(registry or {}, symbols, quantities, ops, prices, timestamps))
+        return trading
+
+    @staticmethod
+    def _check_arrays(stocks, symbols, quantities, ops, prices, timestamps=None):    # checks whole columns at once
+        # returns the columns ready for _add_arrays: (stocks, codes, ops, quantities, prices, timestamps)
+        symbols = np.asarray(symbols)
+        if symbols.dtype.kind == 'O':   # Stock objects
+            stocks = dict(stocks or {}, **{x.symbol: x for x in set(symbols.tolist()) if isinstance(x, Stock)})
+            symbols = np.asarray([str(x) for x in symbols.tolist()])
+        symbols, codes = np.unique(np.char.upper(np.char.strip(symbols.astype(str))), return_inverse=True)
+        missing = [x for x in symbols.tolist() if x not in stocks]
+        if missing:
+            raise Exception('No stock for symbols {}'.format(', '.join(missing)))
+        stocks = [stocks[x] for x in symbols.tolist()]
+
+        ops = np.char.lower(np.char.strip(np.asarray(ops, dtype=str)))
+        sell = ops == 'sell'
+        if not (sell | (ops == 'buy')).all():
+            raise Exception("You should indicate a 'sell' or 'buy' operation")
+
+        quantities = np.asarray(quantities)
+        if quantities.dtype.kind not in 'iuUS' and len(quantities):
+            raise Exception('Quantity must be integer')
+        try:
+            quantities = quantities.astype(np.int64)
+        except ValueError:
+            raise Exception('Quantity must be integer')
+
+        prices = np.asarray(prices)
+        if prices.dtype.kind not in 'iufUS':
+            raise Exception("Price should be a numeric value")
+        try:
+            prices = prices.astype(np.float64)
+        except ValueError:
+            raise Exception("Price should be a numeric value")
+
+        now = to_ns(datetime.utcnow())
+        if timestamps is None:
+            timestamps = np.full(len(codes), now, dtype=np.int64)
+        else:
+            timestamps = np.asarray(timestamps)
+            try:
+                if timestamps.dtype.kind == 'O':
+                    timestamps = np.fromiter((now if x is None else to_ns(x) for x in timestamps.tolist()),
+                                             dtype=np.int64, count=len(timestamps))
+                elif timestamps.dtype.kind in 'US':
+                    timestamps = parse_iso(timestamps)
+                elif timestamps.dtype.kind == 'M':
+                    timestamps = timestamps.astype('datetime64[ns]').astype(np.int64)
+                elif timestamps.dtype.kind not in 'iu' and len(timestamps):
+                    raise TypeError('No time stamps')
+                timestamps = np.where(timestamps == np.iinfo(np.int64).min, now, timestamps)    # no time: time now
+            except (ValueError, TypeError):
+                raise Exception("Time stamp is not in ISO format: YYYY-MM-DDTHH:MM:SS.mmmm")
+        if not (len(codes) == len(ops) == len(quantities) == len(prices) == len(timestamps)):
+            raise Exception('All columns must have the same length')
+        return stocks, codes, sell.astype(np.int8), quantities, prices, timestamps.astype(np.int64)
+
+    @classmethod
+    def from_csv(cls, path, stocks, columnar=True, parse_time=None, chunk=100000):
+        # stocks: registry {symbol: Stock} or list of stocks
+        # parse_time: optional function from the timestamp column (array of strings) to times. ISO format if not
+        registry = stocks if isinstance(stocks, dict) else {x.symbol: x for x in stocks}
+        trading = cls(columnar=columnar)
+        with open(path, mode='r', newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = [x.strip() for x in next(reader)]
+            try:
+                fields = [header.index(x) for x in ('symbol', 'quantity', 'op', 'price')]
+            except ValueError:
+                raise Exception('Columns symbol, op, quantity and price are needed')
+            time_field = header.index('timestamp') if 'timestamp' in header else None
+            while True:
+                rows = list(islice(reader, chunk))
+                if not rows:
+                    break
+                rows = [x for x in rows if x]       # blank lines
+                for row in rows:
+                    if len(row) < len(header):
+                        raise Exception('Row {} has {} fields, {} expected'.format(row, len(row), len(header)))
+                if not rows:
+                    continue
+                table = list(zip(*rows))
+                columns = [np.asarray(table[x]) for x in fields]
+                timestamps = None
+                if time_field is not None:
+                    timestamps = np.char.strip(np.asarray(table[time_field]))
+                    if parse_time:
+                        timestamps = parse_time(timestamps)
+                trading._add_arrays(*cls._check_arrays(registry, *columns, timestamps=timestamps))
+        return trading
+
+    def _symbol_positions(self, key, value):    # index lookup for symbol or stock equality
+        if key == 'stock':
+            return self.index.symbol(value.symbol, self.size) if isinstance(value, Stock) \
+                else np.empty(0, dtype=np.intp)
+        return self.index.symbol(value, self.size)
 
     @TradingFilter()
     def filter(self, **kwargs):                     # you can get all trades just passing NO parameters
-        for key, value in kwargs.items():           # or filter by any trade attribute or a group of attributes
-            self.filter_list = [x for x in self.filter_list if getattr(x, key) == value]
-        return self
+        query = self.query                          # or filter by any trade attribute or a group of attributes
+        for attribute, value, lookup in kwargs.values():
+            query = query.add('filter', attribute, value, lookup)
+        return self._view(query)
 
     @TradingFilter()
     def exclude(self, **kwargs):
-        for key, value in kwargs.items():
-            self.filter_list = [x for x in self.filter_list if getattr(x, key) != value]
-        return self
+        query = self.query
+        for attribute, value, lookup in kwargs.values():
+            query = query.add('exclude', attribute, value, lookup)
+        return self._view(query)
 
     @TradingFilter(time=True)
     def before(self, time):     # all trades BEFORE a time. Needs to_list()
-        self.filter_list = [x for x in self.filter_list if x.timestamp <= time]
-        return self
+        return self._view(self.query.add('before', time))
 
     @TradingFilter(time=True)
     def after(self, time):      # all trades AFTER a time. Needs to_list()
-        self.filter_list = [x for x in self.filter_list if x.timestamp >= time]
-        return self
+        return self._view(self.query.add('after', time))
 
     @TradingFilter()
     def order_by(self, field=None):
@@ -263,46 +1926,933 @@ class Trading:    # A list of trades all together
             field = field[1:]
         else:
             reverse = False
-        if self.filter_list:
-            if not (hasattr(self.filter_list[0], field)):
-                raise Exception('{} attribute doesn\'t exist'.format(field))
-        self.filter_list.sort(key=lambda x: getattr(x, field), reverse=reverse)
-        return self
+        if field not in TradeColumns.attributes:
+            raise Exception('{} attribute doesn\'t exist'.format(field))
+        return self._view(self.query.add('order_by', field, reverse))
 
-    @TradingFilter(clean=True)
+    @METRICS
     def to_list(self):          # Returns the filtered list of trades
-        return self.filter_list
+        if not self.query.steps:
+            return self.columns.trades(range(self.size)) if self.columns is not None \
+                else self.trading_list[:self.size]
+        rows = self.query.rows(self)
+        if self.columns is not None:
+            return self.columns.trades(rows)
+        return [self.trading_list[x] for x in rows.tolist()]
+
+    def _columns(self):     # TradeColumns with the filtered trades (the same ones if possible)
+        if self.columns is not None and not self.query.steps:
+            return self.columns
+        if self.columns is not None:
+            columns = self.columns.share()
+            rows = self.query.rows(self)
+            columns.data = {field: column[rows] for field, column in columns.data.items()}
+            columns.size = len(rows)
+            return columns
+        columns = TradeColumns()
+        columns.extend(self.to_list())
+        return columns
 
-    @TradingFilter(clean=True)
+    @METRICS
     def first(self):
-        return self.filter_list[0]
+        row = self.query.first(self)
+        if self.columns is not None:
+            return self.columns.trade(row)
+        return self.trading_list[row]
 
+    def _arrays(self):      # symbol codes, symbols (by code), quantities and prices of the trades
+        rows = self.query.rows(self) if self.query.steps else None
+        if self.columns is not None:
+            codes = self.columns['symbol']
+            quantities = self.columns['quantity']
+            prices = self.columns['price']
+            if rows is not None:
+                codes, quantities, prices = codes[rows], quantities[rows], prices[rows]
+            return codes, [x.symbol for x in self.columns.stocks], quantities.astype(np.float64), prices
+        trades = self.trading_list[:self.size] if rows is None else [self.trading_list[x] for x in rows.tolist()]
+        positions = {}
+        codes = np.fromiter((positions.setdefault(x.symbol, len(positions)) for x in trades),
+                            dtype=np.intp, count=len(trades))
+        quantities = np.fromiter((x.quantity for x in trades), dtype=np.float64, count=len(trades))
+        prices = np.fromiter((x.price for x in trades), dtype=np.float64, count=len(trades))
+        return codes, list(positions), quantities, prices
+
+    @METRICS
     def get_symbols(self):      # gets the different stocks on the trading
-        symbols = []
+        if self.columns is None and self.aggregates is not None:
+            return list(dict.fromkeys(x.symbol for x in islice(self.trading_list, self.size)))
+        codes, symbols, quantities, prices = self._arrays()
+        codes, first = np.unique(codes, return_index=True)     # codes sorted by first appearance
+        return [symbols[code] for code in codes[np.argsort(first)]]
+
+    @METRICS
+    def weighted_price(self, symbol, window=None):  # calculates the Volume Weighted Stock Price for a given symbol
+        if self.aggregates is None:     # a view calculates over its own trades
+            view = self.filter(symbol=symbol)
+            if window is not None:
+                now = datetime.utcnow()
+                return view.after(now - window).before(now).stock_index()[0][symbol]
+            version = self.index.version(symbol, self.size)
+            return self.cache.get(('weighted_price', self.query.steps, symbol, version),
+                                  lambda: view._stock_index()[0][symbol])
+        if window is None:
+            return self.aggregates.weighted_price(symbol)
+        if window not in self.windows:      # first time for this window length
+            trade_window = TradeWindow(window)
+            if self.columns is not None:
+                trade_window.add_columns(self.columns)
+            else:
+                trade_window.add_trades(self.trading_list[:self.size])
+            self.windows[window] = trade_window
+        return self.windows[window].weighted_price(symbol, datetime.utcnow())
+
+    @METRICS
+    def bars(self, symbol, width=timedelta(minutes=1), start=None, end=None):
+        # open, high, low, close, volume, vwap and count bars of a symbol starting from start to end (excluded)
+        # as a numpy structured array. Bars start at epoch nanoseconds multiple of the width
+        if self.aggregates is None:     # a view calculates over its own trades
+            trade_bars = TradeBars(width)
+            trade_bars.add_columns(self.filter(symbol=symbol)._columns())
+            return trade_bars.bars(symbol, start, end)
+        if width not in self.candles:       # first time for this width. Then kept up to date on additions
+            trade_bars = TradeBars(width)
+            if self.columns is not None:
+                trade_bars.add_columns(self.columns)
+            else:
+                trade_bars.add_trades(self.trading_list[:self.size])
+            self.candles[width] = trade_bars
+        return self.candles[width].bars(symbol, start, end)
 
-        for elem in self.trading_list:
-            if elem.symbol not in symbols:
-                symbols.append(elem.symbol)
-        return symbols
+    @staticmethod
+    def _factorize(column):     # sorted unique integer keys and the code (index in them) of every value
+        if len(column):
+            low = column.min()
+            span = int(column.max() - low) + 1
+            if span <= max(len(column), 1024):      # dense keys: counting instead of sorting
+                shifted = column - low
+                present = np.bincount(shifted, minlength=span) > 0
+                return np.flatnonzero(present) + low, (np.cumsum(present) - 1)[shifted]
+        unique, inverse = np.unique(column, return_inverse=True)
+        return unique, inverse.reshape(-1)
 
-    def weighted_price(self, symbol):   # calculates the Volume Weighted Stock Price for a given symbol
+    @METRICS
+    def aggregate(self, by=('symbol',), metrics=('count', 'volume', 'notional', 'vwap')):
+        # one row per group of trades as a numpy structured array sorted by the keys. Keys (by):
+        #   'symbol', 'op' or a timedelta: time buckets of that width ('start' field, epoch nanoseconds)
+        # metrics: count, volume, notional, vwap, buy_volume, sell_volume and imbalance (buy - sell) / volume
+        # every key column is factorized once and every metric is one bincount over the group codes
+        by = (by,) if isinstance(by, (str, timedelta)) else by      # a single key
+        metrics = (metrics,) if isinstance(metrics, str) else metrics
+        for metric in metrics:
+            if metric not in self.aggregations:
+                raise Exception('{} metric doesn\'t exist'.format(metric))
+        columns = self._columns()
+        keys = []       # (field, integer key of every trade sorting as the field, field values of the keys)
+        for key in by:
+            if isinstance(key, timedelta):
+                width = key // timedelta(microseconds=1) * 1000
+                if width <= 0:
+                    raise Exception('Time buckets need a positive width')
+                keys.append(('start', columns['timestamp'] // width, width))
+            elif key in ('symbol', 'stock'):
+                symbols = np.array(sorted(x.symbol for x in columns.stocks), dtype='U3')
+                keys.append(('symbol', columns.sort_key('symbol'), symbols))
+            elif key == 'op':
+                keys.append(('op', columns['op'], np.array(TradeColumns.ops, dtype='U4')))
+            else:
+                raise Exception('{} attribute can\'t be a key'.format(key))
 
-        stock_list = self.filter(symbol=symbol).to_list()
-        if not stock_list:
+        groups = np.zeros(len(columns), dtype=np.int64)     # group code of every trade (mixed radix)
+        uniques = []
+        for field, column, names in keys:
+            unique, inverse = self._factorize(column)
+            groups = groups * len(unique) + inverse
+            uniques.append(unique)
+        groups, inverse = self._factorize(groups)
+        table = np.zeros(len(groups), dtype=[(x[0], '<i8' if x[0] == 'start' else x[2].dtype) for x in keys] +
+                         [(x, self.aggregations[x]) for x in metrics])
+        for (field, column, names), unique in zip(reversed(keys), reversed(uniques)):     # keys back from codes
+            values = unique[groups % len(unique)]
+            table[field] = values * names if field == 'start' else names[values]
+            groups = groups // len(unique)
+
+        quantities = columns['quantity'].astype(np.float64)
+        totals = {}
+
+        def total(name):
+            if name not in totals:
+                weights = {'count': None, 'volume': quantities, 'notional': quantities * columns['price'],
+                           'buy_volume': np.where(columns['op'] == 0, quantities, 0),
+                           'sell_volume': np.where(columns['op'] == 1, quantities, 0)}[name]
+                totals[name] = np.bincount(inverse, weights=weights, minlength=len(table))
+            return totals[name]
+
+        for metric in metrics:
+            if metric == 'vwap':
+                table[metric] = total('notional') / total('volume')
+            elif metric == 'imbalance':
+                table[metric] = (total('buy_volume') - total('sell_volume')) / total('volume')
+            else:
+                table[metric] = total(metric)
+        return table
+
+    @METRICS
+    def stock_index(self):      # Volume Weighted Stock Price for every symbol and its geometric mean in one pass
+        # symbols are factorized to codes once and all prices come from two weighted bincounts (float64)
+        # returns ({symbol: weighted price}, geometric mean)
+        table, mean = self.cache.get(('stock_index', self.query.steps, self.size), self._stock_index)
+        return dict(table), mean
+
+    def _stock_index(self):
+        codes, symbols, quantities, prices = self._arrays()
+        if not len(codes):
             raise Exception('No objects on this query')
-        matrix = np.asarray([[x.quantity, x.price] for x in stock_list], dtype=np.float32)
-        prices = matrix[:,1]
-        quantities = matrix[:,0]
-        total_quantities = sum(quantities)
-        if total_quantities == 0:
-            raise Exception('Divide by 0!')
 
-        return sum(np.multiply(prices, quantities)) / total_quantities
+        volumes = np.bincount(codes, weights=quantities, minlength=len(symbols))
+        notionals = np.bincount(codes, weights=prices * quantities, minlength=len(symbols))
+        present = np.bincount(codes, minlength=len(symbols)) > 0
+        if (volumes[present] == 0).any():
+            raise Exception('Divide by 0!')
+        weights = notionals[present] / volumes[present]
+        table = dict(zip((x for x, y in zip(symbols, present) if y), weights.tolist()))
+        return table, gmean(weights)
 
+    @METRICS
     def geometric_mean(self):       # geometric mean for whole trading
-        stock_symbols = self.get_symbols()
-        weights = [self.weighted_price(x) for x in stock_symbols]
-        if not weights:
+        if self.aggregates is None:
+            return self.stock_index()[1]
+        return self.aggregates.geometric_mean()
+
+
+def _shard(connection, columnar):      # worker process serving a shard of a ShardedTrading
+    trading = Trading(columnar=columnar)
+    stocks = {}
+    sequences = [np.empty(0, dtype=np.int64)]      # global order of the trades of the shard
+
+    def sequence():
+        if len(sequences) > 1:
+            sequences[:] = [np.concatenate(sequences)]
+        return sequences[0]
+
+    def rows(query):
+        return query.rows(trading) if query.steps else np.arange(trading.size)
+
+    def columns(positions):     # columns of some trades, with the symbols of their codes
+        if trading.columns is not None:
+            data = trading.columns.data
+            symbols = [x.symbol for x in trading.columns.stocks]
+            return (symbols, data['symbol'][positions], data['op'][positions], data['quantity'][positions],
+                    data['price'][positions], data['timestamp'][positions], sequence()[positions])
+        picked = TradeColumns()
+        picked.extend([trading.trading_list[x] for x in positions.tolist()])
+        return ([x.symbol for x in picked.stocks], picked['symbol'], picked['op'], picked['quantity'],
+                picked['price'], picked['timestamp'], sequence()[positions])
+
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        command, query, arguments = message
+        view = trading._view(query) if query.steps else trading
+        try:
+            if command == 'add':
+                shard_stocks, codes, ops, quantities, prices, timestamps, numbers = arguments
+                shard_stocks = [stocks.setdefault(x.symbol, x) for x in shard_stocks]
+                trading._add_arrays(shard_stocks, codes, ops, quantities, prices, timestamps)
+                sequences.append(numbers)
+                result = None
+            elif command == 'rows':
+                result = columns(rows(query))
+            elif command == 'first':
+                try:
+                    position = query.first(trading)
+                except Exception:       # none in this shard
+                    position = None
+                result = None if position is None else columns(np.array([position], dtype=np.intp))
+            elif command == 'weighted_price':
+                result = view.weighted_price(*arguments)
+            elif command == 'stock_index':
+                if view is trading:     # from the running totals
+                    result = {x: trading.aggregates.weighted_price(x) for x in trading.aggregates.volume}
+                else:
+                    result = view.stock_index()[0] if len(rows(query)) else {}
+            elif command == 'symbols':      # {symbol: sequence number of its first trade}
+                names, codes, numbers = (columns(rows(query))[x] for x in (0, 1, 6))
+                codes, first = np.unique(codes, return_index=True)
+                result = dict(zip((names[x] for x in codes.tolist()), numbers[first].tolist()))
+            else:
+                raise Exception('Unknown command {}'.format(command))
+        except Exception as error:
+            result = error
+        connection.send(result)
+
+
+class ShardedTrading:
+
+    """
+    A trading split by symbol across worker processes (shards), each one holding a Trading with the trades
+    of its symbols. Same queries as a Trading:
+
+        filter, exclude, before, after, order_by: views with a lazy query (TradingQuery)
+        to_list, first: the trades, in the same order a Trading gives them
+        get_symbols, weighted_price, stock_index, geometric_mean
+
+    sharded = ShardedTrading(stocks, shards=4): stocks registry ({symbol: Stock}) or list of stocks, to add
+                                                trades by symbol. shards: worker processes (cpu count if None)
+        columnar: shards keep columnar tradings
+    sharded += trade, list of trades or Trading: trades are checked once, split by symbol (crc32 of the
+                                                 symbol, so every process agrees) and sent to their shards
+    sharded.add_arrays(symbols, quantities, ops, prices, timestamps=None): adds whole columns
+    sharded.close() stops the workers (also as a context manager)
+
+    Every query is sent to all the shards at once and they run it in parallel. Weighted prices of a symbol
+    are asked to its shard only. Every shard computes the weighted prices of its symbols and the geometric
+    mean is computed from all of them here.
+    A global sequence number is kept with every trade, so merged results come in the order of addition.
+
+    """
+
+    def __init__(self, stocks=None, shards=None, columnar=True):
+        self.stocks = dict(stocks) if isinstance(stocks, dict) else {x.symbol: x for x in stocks or []}
+        self.workers = []
+        import multiprocessing      # imported on first use: keeps the module quick to import
+        for _ in range(shards or os.cpu_count() or 1):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard, args=(worker_connection, columnar), daemon=True)
+            process.start()
+            self.workers.append((process, connection))
+        self.size = 0
+        self.query = TradingQuery()
+        self.root = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for process, connection in self.workers:
+            if process.is_alive():
+                connection.send(None)
+                process.join()
+
+    def shard(self, symbol):     # shard of a symbol
+        return zlib.crc32(symbol.encode()) % len(self.workers)
+
+    def _ask(self, command, arguments=None, shards=None):     # sends a command to some shards and gets the results
+        def symbol(stock):
+            return stock.symbol if isinstance(stock, Stock) else None
+
+        query = TradingQuery(tuple(x if x[0] not in ('filter', 'exclude') or x[1] != 'stock' else
+                                   (x[0], 'symbol', tuple(map(symbol, x[2])) if x[3] == 'in' else symbol(x[2]), x[3])
+                                   for x in self.query.steps))   # stocks of this process are not the shard ones
+        shards = range(len(self.workers)) if shards is None else shards
+        for shard in shards:
+            self.workers[shard][1].send((command, query, arguments))
+        results = [self.workers[shard][1].recv() for shard in shards]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def _view(self, query):
+        view = ShardedTrading.__new__(ShardedTrading)
+        view.__dict__.update(self.__dict__)
+        view.query = query
+        view.root = False
+        return view
+
+    filter = Trading.filter
+    exclude = Trading.exclude
+    before = Trading.before
+    after = Trading.after
+    order_by = Trading.order_by
+
+    def __iadd__(self, other):
+        if not self.root:
+            raise Exception('A filtered trading can not be added to')
+        if type(other) == Trade:
+            other = [other]
+        if type(other) == list:
+            if other and set(map(type, other)) != {Trade}:
+                raise Exception('All objects should be Trade type')
+            columns = TradeColumns()
+            columns.extend(other)
+        elif type(other) == Trading:
+            columns = other._columns()
+        else:
+            raise Exception('Object must be Trade, a Trading or a list of Trade objects')
+        self._add_arrays(columns.stocks, columns['symbol'], columns['op'], columns['quantity'], columns['price'],
+                         columns['timestamp'])
+        return self
+
+    def add_arrays(self, symbols, quantities, ops, prices, timestamps=None):     # whole columns checked at once
+        if not self.root:
+            raise Exception('A filtered trading can not be added to')
+        self._add_arrays(*Trading._check_arrays(self.stocks, symbols, quantities, ops, prices, timestamps))
+
+    def _add_arrays(self, stocks, codes, ops, quantities, prices, timestamps):
+        for stock in stocks:
+            self.stocks.setdefault(stock.symbol, stock)
+        owners = np.array([self.shard(x.symbol) for x in stocks], dtype=np.intp)[codes] if len(codes) \
+            else np.empty(0, dtype=np.intp)
+        numbers = np.arange(self.size, self.size + len(codes), dtype=np.int64)
+        for shard in range(len(self.workers)):
+            rows = np.flatnonzero(owners == shard)
+            if len(rows):
+                used, local = np.unique(codes[rows], return_inverse=True)
+                self.workers[shard][1].send(('add', TradingQuery(), (
+                    [stocks[x] for x in used.tolist()], local, ops[rows], quantities[rows], prices[rows],
+                    timestamps[rows], numbers[rows])))
+        for shard in range(len(self.workers)):
+            if np.any(owners == shard):
+                result = self.workers[shard][1].recv()
+                if isinstance(result, Exception):
+                    raise result
+        self.size += len(codes)
+
+    def _merge(self, results):      # shard results merged as columns and their order for the query
+        results = [x for x in results if x is not None and len(x[1])]
+        if not results:
+            return None
+        symbols = np.concatenate([np.asarray(x[0])[x[1]] for x in results])
+        ops, quantities, prices, timestamps, numbers = (np.concatenate([x[field] for x in results])
+                                                        for field in range(2, 7))
+        order = np.argsort(numbers, kind='stable')
+        keys = {'stock': symbols, 'symbol': symbols, 'op': ops, 'quantity': quantities, 'price': prices,
+                'timestamp': timestamps}
+        for attribute, reverse in self.query._compile()[3]:
+            values = keys[attribute][order]
+            if reverse:
+                order = order[::-1][np.argsort(values[::-1], kind='stable')][::-1]
+            else:
+                order = order[np.argsort(values, kind='stable')]
+        return order, symbols, ops, quantities, prices, timestamps
+
+    def _trades(self, results):     # shard results merged as trades, in the order of the query
+        merged = self._merge(results)
+        if merged is None:
+            return []
+        order, symbols, ops, quantities, prices, timestamps = merged
+        return [Trade._restore(self.stocks[symbol], quantity, TradeColumns.ops[op], price, timestamp)
+                for symbol, op, quantity, price, timestamp in zip(symbols[order].tolist(), ops[order].tolist(),
+                                                                  quantities[order].tolist(),
+                                                                  prices[order].tolist(), timestamps[order].tolist())]
+
+    def to_list(self):
+        return self._trades(self._ask('rows'))
+
+    def first(self):
+        trades = self._trades(self._ask('first'))
+        if not trades:
+            raise Exception('No objects on this query')
+        return trades[0]
+
+    def get_symbols(self):
+        if self.query._compile()[3]:        # ordered: as they come in the ordered trades
+            merged = self._merge(self._ask('rows'))
+            return [] if merged is None else list(dict.fromkeys(merged[1][merged[0]].tolist()))
+        seen = {}
+        for symbols in self._ask('symbols'):
+            seen.update(symbols)
+        return sorted(seen, key=seen.get)
+
+    def weighted_price(self, symbol, window=None):
+        return self._ask('weighted_price', (symbol, window), [self.shard(symbol)])[0]
+
+    def stock_index(self):
+        table = {}
+        for weights in self._ask('stock_index'):
+            table.update(weights)
+        if not table:
             raise Exception('No objects on this query')
-        return gmean(weights)
+        return table, gmean(list(table.values()))
+
+    def geometric_mean(self):
+        return self.stock_index()[1]
+
+
+ATTACHING = threading.Lock()
+
+
+def _attach(name):     # attaches a shared memory segment without taking care of its removal (the publisher does)
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:       # before python 3.13 attaching tracks the segment, which is removed when the process ends
+        with ATTACHING:
+            register, resource_tracker.register = resource_tracker.register, lambda *args: None
+            try:
+                return shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+
+
+class TradePublisher:
+
+    """
+    publishes the trades of a trading in shared memory, for reader processes (TradeReader) to query them
+    without copies
+
+    publisher = TradePublisher(trading, name): publishes the trading. name of the shared memory (made up if None)
+    publisher.publish(): publishes the trades added since the last time. Returns the trades published
+    publisher.close(): removes the shared memory (also as a context manager)
+
+    Shared memory:
+        name: header, int64 values: sequence, generation, size, stocks, capacity, stock capacity
+        name-generation: trade columns (timestamp, price, quantity, symbol code, op code) for capacity trades
+                         and the stock table for stock capacity stocks
+    Trades are append-only, so published rows never change: new rows are written past the published size
+    and then the header is changed as a seqlock (odd sequence while changing). When the columns are full a
+    new generation twice as big is made. Readers keep the old ones attached until they refresh.
+
+    """
+
+    stock = np.dtype([('symbol', 'S3'), ('preferred', '?'), ('last_dividend', '<f8'), ('par_value', '<f8'),
+                      ('fixed_dividend', '<f8')])
+    fields = (('timestamp', np.int64), ('price', np.float64), ('quantity', np.int64), ('symbol', np.int32),
+              ('op', np.int8))
+    header = 6
+
+    def __init__(self, trading, name=None, capacity=1024, stock_capacity=64):
+        if trading.aggregates is None:
+            raise Exception('A filtered trading can not be published')
+        self.trading = trading
+        self.name = name or 'trading-{}-{}'.format(os.getpid(), id(self))
+        from multiprocessing import shared_memory
+        self.memory = shared_memory.SharedMemory(name=self.name, create=True, size=8 * self.header)
+        self.values = np.ndarray(self.header, dtype=np.int64, buffer=self.memory.buf)
+        self.values[:] = 0
+        self.generation = None
+        self.segment = None
+        self.retired = None
+        self.codes = {}     # symbol -> code in the shared stock table
+        self.published = 0
+        self._allocate(capacity, stock_capacity)
+        self.publish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @classmethod
+    def layout(cls, memory, capacity, stock_capacity):      # arrays of a generation over its shared memory
+        arrays = {}
+        offset = 0
+        for field, dtype in cls.fields:
+            arrays[field] = np.ndarray(capacity, dtype=dtype, buffer=memory.buf, offset=offset)
+            offset += capacity * np.dtype(dtype).itemsize
+        offset += -offset % 8
+        arrays['stocks'] = np.ndarray(stock_capacity, dtype=cls.stock, buffer=memory.buf, offset=offset)
+        return arrays
+
+    @classmethod
+    def size(cls, capacity, stock_capacity):
+        size = sum(capacity * np.dtype(x[1]).itemsize for x in cls.fields)
+        return size + -size % 8 + stock_capacity * cls.stock.itemsize
+
+    def _allocate(self, capacity, stock_capacity):     # a new generation, with the published trades and stocks
+        generation = 0 if self.generation is None else self.generation + 1
+        name = '{}-{}'.format(self.name, generation)
+        from multiprocessing import shared_memory
+        memory = shared_memory.SharedMemory(name=name, create=True, size=self.size(capacity, stock_capacity))
+        arrays = self.layout(memory, capacity, stock_capacity)
+        if self.segment is not None:
+            for field, _ in self.fields:
+                arrays[field][:self.published] = self.arrays[field][:self.published]
+            arrays['stocks'][:len(self.codes)] = self.arrays['stocks'][:len(self.codes)]
+            self.retired = self.segment     # removed once the header points to the new generation
+        self.segment, self.arrays, self.generation = memory, arrays, generation
+        self.capacity, self.stock_capacity = capacity, stock_capacity
+
+    def publish(self):
+        trading = self.trading
+        if trading.columns is not None:
+            columns, start = trading.columns, self.published
+        else:
+            columns, start = TradeColumns(), 0
+            columns.extend(trading.trading_list[self.published:trading.size])
+        number = trading.size - self.published
+        new = [x for x in columns.stocks if x.symbol not in self.codes]
+        capacity, stock_capacity = self.capacity, self.stock_capacity
+        while self.published + number > capacity:
+            capacity *= 2
+        while len(self.codes) + len(new) > stock_capacity:
+            stock_capacity *= 2
+        if (capacity, stock_capacity) != (self.capacity, self.stock_capacity):
+            self._allocate(capacity, stock_capacity)
+
+        for stock in new:       # past the published stocks: readers don't read them yet
+            code = len(self.codes)
+            self.arrays['stocks'][code] = (stock.symbol.encode('ascii'), stock.stock_type == 'preferred',
+                                           stock.last_dividend, stock.par_value, stock.fixed_dividend)
+            self.codes[stock.symbol] = code
+        rows = slice(self.published, self.published + number)
+        lookup = np.array([self.codes[x.symbol] for x in columns.stocks], dtype=np.int32)
+        if number:
+            self.arrays['symbol'][rows] = lookup[columns['symbol'][start:start + number]]
+            for field in ('op', 'quantity', 'price', 'timestamp'):
+                self.arrays[field][rows] = columns[field][start:start + number]
+
+        self.values[0] += 1         # odd: changing
+        self.values[1:] = (self.generation, self.published + number, len(self.codes), self.capacity,
+                           self.stock_capacity)
+        self.values[0] += 1         # even: done
+        self.published += number
+        self._retire()
+        return number
+
+    def _retire(self):      # readers attached to an old generation keep it until they let it go
+        if self.retired is not None:
+            self.retired.close()
+            self.retired.unlink()
+            self.retired = None
+
+    def close(self):
+        self.arrays = self.values = None
+        self._retire()
+        for memory in (self.segment, self.memory):
+            memory.close()
+            memory.unlink()
+
+
+class TradeReader:
+
+    """
+    attaches to the trades published by a TradePublisher (maybe of another process) and serves them as a
+    columnar Trading whose columns are the shared memory itself
+
+    reader = TradeReader(name, timeout=1.0)
+        timeout: seconds waiting for a publisher in the middle of a publish. A publisher gone while publishing,
+                 or gone with trades not read yet, raises an Exception instead of waiting forever
+    reader.trading(): the trading as last published. Running totals and indexes are kept by the reader and
+                      updated with the rows published since the last call only. Appending to a trading handed
+                      out copies its trades first, so the reader's ones never change
+    reader.close(): detaches (also as a context manager)
+
+    """
+
+    def __init__(self, name, timeout=1.0):
+        self.name = name
+        self.timeout = timeout
+        self.memory = _attach(name)
+        self.values = np.ndarray(TradePublisher.header, dtype=np.int64, buffer=self.memory.buf)
+        self.segments = {}      # generation -> (shared memory, arrays)
+        self.stocks = []
+        self.codes = {}
+        self.current = Trading(columnar=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _header(self):      # generation, size, stocks, capacity and stock capacity, consistent (seqlock)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            sequence = int(self.values[0])
+            if sequence % 2:
+                if time.monotonic() > deadline:
+                    raise Exception('The publisher of {} stopped while publishing'.format(self.name))
+                time.sleep(0)
+                continue
+            header = tuple(int(x) for x in self.values[1:])
+            if int(self.values[0]) == sequence:
+                return header
+
+    def _arrays(self):      # size, stocks and arrays as last published
+        while True:
+            generation, size, stocks, capacity, stock_capacity = self._header()
+            if generation not in self.segments:
+                try:
+                    memory = _attach('{}-{}'.format(self.name, generation))
+                except FileNotFoundError:
+                    if self._header()[0] != generation:     # replaced by a newer generation in the meantime
+                        continue
+                    raise Exception('{} is no longer published'.format(self.name))
+                arrays = TradePublisher.layout(memory, capacity, stock_capacity)
+                for array in arrays.values():
+                    array.flags.writeable = False
+                self.segments[generation] = (memory, arrays)
+            return size, stocks, self.segments[generation][1]
+
+    def trading(self):
+        size, stocks, arrays = self._arrays()
+        for row in arrays['stocks'][len(self.stocks):stocks].tolist():
+            symbol, preferred, last_dividend, par_value, fixed_dividend = row
+            stock = Stock(symbol.decode('ascii'), 'preferred' if preferred else 'common', last_dividend, par_value,
+                          fixed_dividend * 100 or None)
+            stock.fixed_dividend = fixed_dividend
+            self.stocks.append(stock)
+        self.codes.update((x.symbol, code) for code, x in enumerate(self.stocks) if x.symbol not in self.codes)
+
+        trading = self.current
+        start = trading.size
+        trading.columns.stocks = self.stocks
+        trading.columns.codes = self.codes
+        # columns just as big as the trades: appending to a trading got copies them, never writes the shared ones
+        trading.columns.data = {field: arrays[field][:size] for field, _ in TradePublisher.fields}
+        trading.columns.size = size
+        trading._grown(size - start)
+        trading._added_columns(start)
+        handed = trading._share()       # the trading handed out never changes
+        handed.tip = [None]     # and is never the tip: the reader keeps its storage, appending to it copies first
+        return handed
+
+    def close(self):
+        self.current = self.values = None
+        segments, self.segments = self.segments, {}
+        for memory in [self.memory] + [x[0] for x in segments.values()]:
+            try:
+                memory.close()
+            except BufferError:     # tradings still in use: unmapped when they are gone
+                pass
+
+
+class TradeGateway:
+
+    """
+    asyncio ingestion gateway: producers send trades over a local TCP or Unix socket and they are added to a
+    trading in bulk appends
+
+    gateway = TradeGateway(trading, stocks): stocks registry ({symbol: Stock}) or list of stocks
+        batch: most trades added at once
+        depth: most chunks waiting in the queue. When full, connections aren't read (backpressure: the
+               producers block on their sockets) until the trading catches up
 
+    await gateway.start(('127.0.0.1', 0)) or start('/tmp/trades.sock'): serves on a TCP or Unix socket address.
+    gateway.address is the address served
+    await gateway.flush(): waits for the trades received to be added
+    await gateway.stop(): stops serving. Waits for the connections to end and their trades to be added
+    gateway.metrics(): trades, batches, rejected trades, failed batches, connections, queue depth (now and
+                       highest) and the latency from reception to addition (median, 99 percentile and highest)
+                       in seconds
+    A batch that can't be added (a journal write error, for example) is counted as failed and its trades as
+    rejected. The gateway goes on with the next ones.
+
+    messages, chosen by connection:
+        lines: symbol,op,quantity,price[,timestamp] (ISO format. Time now if missing)
+        binary: trade journal records (TradeJournal) after a journal header
+    Wrong messages are rejected (counted) and the others added.
+    await TradeGateway.produce(address, trading, binary=False) is a producer sending the trades of a trading.
+    It returns once the gateway has received them all.
+
+    """
+
+    fields = 5
+    chunk = 65536
+    latencies = 4096        # latencies kept for the metrics
+
+    def __init__(self, trading, stocks, batch=10000, depth=64):
+        if trading.aggregates is None:
+            raise Exception('A filtered trading can not be fed')
+        self.trading = trading
+        self.stocks = stocks if isinstance(stocks, dict) else {x.symbol: x for x in stocks}
+        self.batch = batch
+        self.depth = depth
+        self.queue = None
+        self.server = None
+        self.consumer = None
+        self.address = None
+        self.connections = set()
+        self.counts = {'trades': 0, 'batches': 0, 'rejected': 0, 'failed': 0, 'connections': 0, 'queue_max': 0}
+        self.latency = deque(maxlen=self.latencies)
+
+    async def start(self, address):
+        import asyncio
+        self.queue = asyncio.Queue(self.depth)
+        self.consumer = asyncio.ensure_future(self._consume())
+        if isinstance(address, str):
+            self.server = await asyncio.start_unix_server(self._connection, path=address, limit=self.chunk)
+            self.address = address
+        else:
+            self.server = await asyncio.start_server(self._connection, *address, limit=self.chunk)
+            self.address = self.server.sockets[0].getsockname()[:2]
+        return self
+
+    async def flush(self):
+        await self.queue.join()
+
+    async def stop(self):       # no new connections. Waits for the open ones to end and their trades to be added
+        import asyncio
+        self.server.close()
+        await asyncio.gather(*self.connections)
+        await self.server.wait_closed()
+        await self.queue.join()
+        self.consumer.cancel()
+
+    def metrics(self):
+        latency = np.asarray(self.latency)
+        metrics = dict(self.counts, queue_depth=self.queue.qsize() if self.queue else 0)
+        metrics['latency'] = {'p50': float(np.percentile(latency, 50)) if len(latency) else 0.0,
+                              'p99': float(np.percentile(latency, 99)) if len(latency) else 0.0,
+                              'max': float(latency.max()) if len(latency) else 0.0}
+        return metrics
+
+    async def _connection(self, reader, writer):
+        import asyncio
+        self.counts['connections'] += 1
+        task = asyncio.current_task()
+        self.connections.add(task)
+        rest = b''
+        binary = None
+        try:
+            while True:
+                data = await reader.read(self.chunk)
+                if not data:
+                    break
+                received = time.perf_counter()
+                rest += data
+                if binary is None:
+                    if len(rest) < len(TradeJournal.magic) and TradeJournal.magic.startswith(rest):
+                        continue
+                    binary = rest.startswith(TradeJournal.magic)
+                    if binary:
+                        if len(rest) < TradeJournal.header.itemsize:
+                            binary = None
+                            continue
+                        rest = rest[TradeJournal.header.itemsize:]
+                if binary:
+                    whole = len(rest) - len(rest) % TradeJournal.record.itemsize
+                    messages, rest = rest[:whole], rest[whole:]
+                    columns = self._records(messages)
+                else:
+                    whole = rest.rfind(b'\n') + 1
+                    messages, rest = rest[:whole], rest[whole:]
+                    columns = self._lines(messages)
+                if columns is not None:
+                    await self.queue.put((received, columns))   # waits (stops reading) while the queue is full
+                    self.counts['queue_max'] = max(self.counts['queue_max'], self.queue.qsize())
+            if rest.strip() and not binary:     # a last line without end of line
+                columns = self._lines(rest + b'\n')
+                if columns is not None:
+                    await self.queue.put((time.perf_counter(), columns))
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    def _records(self, messages):
+        records = np.frombuffer(messages, dtype=TradeJournal.record)
+        if not len(records):
+            return None
+        ops = np.where(records['op'] == 0, 'buy', np.where(records['op'] == 1, 'sell', ''))
+        return self._check(np.char.decode(records['symbol'], 'ascii', 'replace'), records['quantity'], ops,
+                           records['price'], records['timestamp'])
+
+    def _lines(self, messages):
+        rows = [x.split(',') for x in messages.decode('utf-8', 'replace').splitlines() if x.strip()]
+        good = [x + [''] * (self.fields - len(x)) for x in rows if self.fields - 1 <= len(x) <= self.fields]
+        self.counts['rejected'] += len(rows) - len(good)
+        if not good:
+            return None
+        symbols, ops, quantities, prices, timestamps = (np.asarray(x) for x in zip(*good))
+        return self._check(symbols, quantities, ops, prices, timestamps)
+
+    def _check(self, *columns):     # checked columns. Wrong trades are left out and rejected
+        try:
+            return Trading._check_arrays(self.stocks, *columns)
+        except Exception:
+            pass
+        good = self._valid(*columns)
+        self.counts['rejected'] += int((~good).sum())
+        try:
+            return Trading._check_arrays(self.stocks, *(x[good] for x in columns)) if good.any() else None
+        except Exception:       # something the masks don't see, as a quantity too big for int64
+            self.counts['rejected'] += int(good.sum())
+            return None
+
+    def _valid(self, symbols, quantities, ops, prices, timestamps):     # the good rows, all checked at once
+        symbols = np.char.upper(np.char.strip(np.asarray(symbols, dtype=str)))
+        valid = np.isin(symbols, list(self.stocks))
+        valid &= np.isin(np.char.lower(np.char.strip(np.asarray(ops, dtype=str))), ('buy', 'sell'))
+        valid &= self._numeric(quantities, integer=True) & self._numeric(prices)
+        timestamps = np.asarray(timestamps)
+        if timestamps.dtype.kind in 'US':
+            valid &= _parse_iso(timestamps)[1]
+        elif timestamps.dtype.kind not in 'iu':
+            valid[:] = False
+        return valid
+
+    @staticmethod
+    def _numeric(column, integer=False):     # which values are numbers (integers) or strings of them
+        column = np.asarray(column)
+        if column.dtype.kind in ('iu' if integer else 'iuf'):
+            return np.ones(len(column), dtype=bool)
+        if column.dtype.kind not in 'US':
+            return np.zeros(len(column), dtype=bool)
+
+        def digits(part, point=False):     # an optional sign and digits, with at most one point
+            unsigned = np.char.lstrip(part, '+-')
+            body = np.char.replace(unsigned, '.', '', 1) if point else unsigned
+            return (np.char.str_len(part) - np.char.str_len(unsigned) <= 1) & \
+                np.char.isdigit(np.char.encode(body, 'ascii', 'replace'))
+
+        text = np.char.lower(np.char.strip(column.astype(str)))
+        if integer:
+            return digits(text)
+        mantissa, exponent, power = np.moveaxis(np.char.partition(text, 'e'), -1, 0)
+        return digits(mantissa, point=True) & ((exponent == '') | digits(power)) | \
+            np.isin(np.char.lstrip(text, '+-'), ('nan', 'inf', 'infinity'))
+
+    async def _consume(self):
+        while True:
+            chunks = [await self.queue.get()]
+            number = len(chunks[0][1][1])
+            while number < self.batch and not self.queue.empty():
+                chunks.append(self.queue.get_nowait())
+                number += len(chunks[-1][1][1])
+            try:
+                self._append([x[1] for x in chunks])
+                added = time.perf_counter()
+                self.latency.extend(added - x[0] for x in chunks)
+            except Exception:
+                self.counts['rejected'] += number
+                self.counts['failed'] += 1
+            finally:
+                for _ in chunks:
+                    self.queue.task_done()
+
+    def _append(self, chunks):      # every chunk in one bulk append
+        stocks, codes = [], []
+        for chunk in chunks:
+            codes.append(chunk[1] + len(stocks))
+            stocks.extend(chunk[0])
+        columns = [np.concatenate([x[field] for x in chunks]) for field in range(2, 6)]
+        self.trading._add_arrays(stocks, np.concatenate(codes), *columns)
+        self.counts['trades'] += sum(len(x) for x in codes)
+        self.counts['batches'] += 1
+
+    @staticmethod
+    async def produce(address, trading, binary=False, chunk=10000):    # sends the trades of a trading
+        import asyncio
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+        columns = trading._columns()
+        if binary:
+            writer.write(np.array([(TradeJournal.magic, TradeJournal.version, TradeJournal.record.itemsize)],
+                                  dtype=TradeJournal.header).tobytes())
+        symbols = np.array([x.symbol for x in columns.stocks])
+        records = TradeJournal.encode(columns) if binary else None
+        for start in range(0, len(columns), chunk):
+            rows = slice(start, start + chunk)
+            if binary:
+                writer.write(records[rows].tobytes())
+            else:
+                times = np.datetime_as_string(columns['timestamp'][rows].astype('datetime64[ns]'))
+                lines = zip(symbols[columns['symbol'][rows]].tolist(), np.asarray(TradeColumns.ops)[
+                    columns['op'][rows]].tolist(), columns['quantity'][rows].tolist(),
+                    columns['price'][rows].tolist(), times.tolist())
+                writer.write(''.join('{},{},{},{!r},{}\n'.format(*x) for x in lines).encode())
+            await writer.drain()        # waits while the gateway isn't reading
+        writer.write_eof()
+        await reader.read()     # the gateway closes once every trade sent is received
+        writer.close()
+        await writer.wait_closed()
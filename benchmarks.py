@@ -0,0 +1,229 @@
+"""
+Benchmarks for the trading
+
+    python benchmarks.py memory [number]: bytes per trade for a dictionary based trade (the former Trade layout),
+                                           the __slots__ Trade and a columnar trading
+
+    python benchmarks.py suite [sizes] [options]: times every operation over synthetic tradings of some sizes
+        --list: list of trades tradings instead of columnar ones
+        --symbols 50 --skew 1.1 --span 86400 --seed 0: the synthetic market (skew of the symbols popularity,
+                                                          span of the trades times in seconds)
+        --repeat 3: best time of some runs
+        --save results.json: stores the results as baseline
+        --baseline results.json --tolerance 0.25: shows the operations slower (or bigger) than the baseline
+
+    python benchmarks.py startup [--repeat 5] [--budget 0.5]: cold import time of the trading module in new
+        interpreters, and the heavy modules (scipy, asyncio, multiprocessing) it loads up front. Fails over the
+        budget (seconds) or when any of them is loaded
+
+    The synthetic markets are seeded, so every run (and machine) benchmarks the same trades.
+
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta
+import numpy as np
+from beberagestockmarket import Stock, Trade, Trading, to_ns
+
+START = datetime(2019, 3, 1)
+HEAVY = ('scipy', 'asyncio', 'multiprocessing')    # modules only loaded when their features are used
+
+
+class DictTrade:    # Trade as it was before __slots__: instance dictionary and its own symbol and op strings
+
+    def __init__(self, stock, quantity, op, price, timestamp):
+        self.stock = stock
+        self.symbol = stock.symbol
+        self.quantity = quantity
+        self.price = price
+        self.op = op.lower()
+        self.timestamp = timestamp
+
+
+def measure(build):     # bytes allocated (and kept) by build()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def bytes_per_trade(number=100000):     # {'dict': bytes, 'slots': bytes, 'columnar': bytes} per trade
+    stock = Stock('POP', 'common', 8, 100)
+    start = datetime(2019, 3, 1)
+    quantities = [100 + x % 900 for x in range(number)]
+    prices = [100.0 + x % 1000 / 100 for x in range(number)]
+    ops = ['BUY' if x % 2 else 'SELL' for x in range(number)]
+
+    def trades(kind):
+        return [kind(stock, quantity, op, price, start + timedelta(microseconds=x))
+                for x, (quantity, op, price) in enumerate(zip(quantities, ops, prices))]
+
+    def columnar():
+        return Trading.from_arrays([stock] * number, np.asarray(quantities), ops, np.asarray(prices),
+                                   np.arange(number, dtype=np.int64))
+
+    return {'dict': measure(lambda: trades(DictTrade)) / number,
+            'slots': measure(lambda: trades(Trade)) / number,
+            'columnar': measure(columnar) / number}
+
+
+def market(symbols=50, seed=0):     # registry of synthetic stocks ({symbol: Stock}). One of five is preferred
+    random = np.random.default_rng(seed)
+    registry = {}
+    for number in range(symbols):
+        symbol = ''.join(chr(ord('A') + number // 26 ** x % 26) for x in (2, 1, 0))
+        if number % 5 == 4:
+            registry[symbol] = Stock(symbol, 'preferred', int(random.integers(1, 20)), 100, 2)
+        else:
+            registry[symbol] = Stock(symbol, 'common', int(random.integers(0, 20)), 100)
+    return registry
+
+
+def generate(number, stocks, skew=1.1, span=timedelta(days=1), seed=0):
+    # seeded synthetic trades as columns: symbols, quantities, ops, prices and timestamps (epoch nanoseconds)
+    # symbols popularity follows a power law (skew 0 for evenly traded symbols). Times are sorted along the span
+    random = np.random.default_rng(seed)
+    symbols = np.array(sorted(stocks))
+    weights = 1 / np.arange(1, len(symbols) + 1) ** skew
+    codes = random.choice(len(symbols), size=number, p=weights / weights.sum())
+    levels = random.uniform(10, 500, size=len(symbols))
+    prices = np.round(levels[codes] * random.lognormal(0, 0.02, size=number), 2)
+    quantities = random.integers(1, 1000, size=number)
+    ops = np.array(['buy', 'sell'])[random.integers(0, 2, size=number)]
+    start = to_ns(START)
+    timestamps = start + np.sort(random.integers(0, int(span.total_seconds() * 10 ** 9), size=number))
+    return symbols[codes], quantities, ops, prices, timestamps
+
+
+def timed(operation, repeat):       # best time of some runs and the peak memory of one
+    seconds = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = operation()
+        seconds = min(seconds, time.perf_counter() - started)
+        del result
+    tracemalloc.start()
+    operation()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def suite(sizes=(10 ** 5, 10 ** 6), columnar=True, symbols=50, skew=1.1, span=timedelta(days=1), seed=0, repeat=3):
+    # {'mode/operation/size': {'seconds': best time, 'rows_per_second': trades by second, 'peak': bytes}}
+    stocks = market(symbols, seed)
+    mode = 'columnar' if columnar else 'list'
+    results = {}
+    for size in sizes:
+        columns = generate(size, stocks, skew, span, seed)
+        trading = Trading.from_arrays(*columns, stocks=stocks, columnar=columnar)
+        popular, rare = columns[0][0], sorted(stocks)[-1]
+        middle = START + span / 2
+        operations = {
+            'ingest': lambda: Trading.from_arrays(*columns, stocks=stocks, columnar=columnar),
+            'filter_chain': lambda: trading.filter(symbol=popular).exclude(op='sell').filter(quantity=500).to_list(),
+            'filter_rare': lambda: trading.filter(symbol=rare).to_list(),
+            'filter_lookups': lambda: trading.filter(symbol__in=[popular, rare], price__gt=100,
+                                                     quantity__between=(100, 500)).to_list(),
+            'before_after': lambda: trading.after(middle).before(middle + span / 100).to_list(),
+            'order_by': lambda: trading.order_by('-price').first(),
+            'weighted_price': lambda: trading.weighted_price(popular),
+            'weighted_price_view': lambda: trading.filter(op='buy').weighted_price(popular),
+            'geometric_mean': lambda: trading.geometric_mean(),
+            'geometric_mean_view': lambda: trading.exclude(op='sell').geometric_mean(),
+            'aggregate': lambda: trading.aggregate(['symbol', 'op', span / 100], list(Trading.aggregations)),
+        }
+        for name, operation in operations.items():
+            seconds, peak = timed(operation, repeat)
+            results['{}/{}/{}'.format(mode, name, size)] = {'seconds': seconds, 'peak': peak,
+                                                            'rows_per_second': size / max(seconds, 1e-9)}
+    return results
+
+
+def startup(repeat=5):     # {'seconds': best cold import time, 'modules': heavy modules loaded by the import}
+    code = ('import sys, time; started = time.perf_counter(); import beberagestockmarket; '
+            'print(time.perf_counter() - started, *[x for x in {!r} if x in sys.modules])'.format(HEAVY))
+    seconds, modules = float('inf'), set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True).stdout
+        spent, *loaded = output.split()
+        seconds, modules = min(seconds, float(spent)), modules | set(loaded)
+    return {'seconds': seconds, 'modules': sorted(modules)}
+
+
+def compare(results, baseline, tolerance=0.25, floor={'seconds': 0.001, 'peak': 65536}):
+    # regressions against a baseline: [(operation, metric, baseline value, value)] slower or bigger than tolerance
+    # differences under the floor (a millisecond, 64 KB) are noise and never regressions
+    regressions = []
+    for key, result in sorted(results.items()):
+        for metric in ('seconds', 'peak'):
+            if key not in baseline:
+                continue
+            before = baseline[key][metric]
+            if result[metric] > before * (1 + tolerance) and result[metric] - before > floor[metric]:
+                regressions.append((key, metric, before, result[metric]))
+    return regressions
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(prog='benchmarks.py', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    memory = commands.add_parser('memory')
+    memory.add_argument('number', nargs='?', type=int, default=100000)
+    timing = commands.add_parser('suite')
+    timing.add_argument('sizes', nargs='*', type=int, default=[10 ** 5, 10 ** 6])
+    timing.add_argument('--list', action='store_true')
+    timing.add_argument('--symbols', type=int, default=50)
+    timing.add_argument('--skew', type=float, default=1.1)
+    timing.add_argument('--span', type=float, default=86400)
+    timing.add_argument('--seed', type=int, default=0)
+    timing.add_argument('--repeat', type=int, default=3)
+    timing.add_argument('--save')
+    timing.add_argument('--baseline')
+    timing.add_argument('--tolerance', type=float, default=0.25)
+    cold = commands.add_parser('startup')
+    cold.add_argument('--repeat', type=int, default=5)
+    cold.add_argument('--budget', type=float, default=0.5)
+    options = parser.parse_args(arguments)
+
+    if options.command == 'memory':
+        for kind, size in bytes_per_trade(options.number).items():
+            print('{:<10}{:>10.1f} bytes per trade'.format(kind, size))
+    elif options.command == 'suite':
+        results = suite(options.sizes, not options.list, options.symbols, options.skew,
+                        timedelta(seconds=options.span), options.seed, options.repeat)
+        for key, result in results.items():
+            print('{:<40}{:>12.6f} s{:>16,.0f} rows/s{:>14,} bytes peak'.format(
+                key, result['seconds'], result['rows_per_second'], result['peak']))
+        if options.save:
+            with open(options.save, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        if options.baseline:
+            with open(options.baseline) as stored:
+                regressions = compare(results, json.load(stored), options.tolerance)
+            for key, metric, before, now in regressions:
+                print('REGRESSION {:<40}{:<8}{:>16,.6g} -> {:,.6g}'.format(key, metric, before, now))
+            return 1 if regressions else 0
+    elif options.command == 'startup':
+        result = startup(options.repeat)
+        print('{:<10}{:>10.3f} s (budget {} s)'.format('import', result['seconds'], options.budget))
+        for module in result['modules']:
+            print('HEAVY {} loaded on import'.format(module))
+        return 1 if result['seconds'] > options.budget or result['modules'] else 0
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,41 +1,24 @@
 from behave import fixture, use_fixture
-from beberagestockmarket import Trade, Trading, Stock
+from beberagestockmarket import Trading, Stock
 from datetime import datetime, timedelta
 
-import csv
+
+def minutes_from_now(column):   # fixture timestamps are minutes from now
+    now = datetime.utcnow()
+    return [now + timedelta(minutes=float(x)) for x in column]
 
 
 @fixture
 def preload_stocks(context):
 
-    context.stock_list = list()
-    with open('features/fixtures/stocks.csv', mode='r') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            context.stock_list.append(Stock(row['symbol'].strip(),
-                                            row['stock_type'].strip(),
-                                            int(row['last_dividend']),
-                                            float(row['par_value']),
-                                            fixed_dividend=float(row['fix_dividend'])))
+    context.stock_list = list(Stock.from_csv('features/fixtures/stocks.csv').values())
 
 
 @fixture
 def preload_trades(context):
-    trading_list = list()
-    with open('features/fixtures/trades.csv', mode='r') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            stock = next((x for x in context.stock_list if x.symbol == row['symbol'].strip()), None)
-            if not stock:
-                continue
-            timestamp = datetime.utcnow() + timedelta(minutes=float(row['timestamp']))
-            trading_list.append(Trade(stock,
-                                      int(row['quantity']),
-                                      row['op'].strip(),
-                                      float(row['price']),
-                                      timestamp=timestamp))
-
-    context.trading = Trading(trading_list)
+
+    context.trading = Trading.from_csv('features/fixtures/trades.csv', context.stock_list, columnar=False,
+                                       parse_time=minutes_from_now)
 
 
 def before_scenario(context, scenario):
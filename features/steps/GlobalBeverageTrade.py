@@ -134,6 +134,8 @@ def step_impl(context, minutes):
     antes =Trading(context.trading.after(datetime.utcnow() + timedelta(minutes=(-1)*minutes)).before(datetime.utcnow()).to_list())
 
     assert isclose(antes.weighted_price(context.symbol),234.83333,abs_tol=1e-5)
+    assert isclose(context.trading.weighted_price(context.symbol, window=timedelta(minutes=minutes)), 234.83333,
+                   abs_tol=1e-5)
 
 
 
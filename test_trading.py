@@ -1,9 +1,24 @@
+import os
+import asyncio
+import multiprocessing
+import tempfile
+import threading
 import unittest
 import beberagestockmarket
-from beberagestockmarket import Trading, Trade
+import benchmarks
+from beberagestockmarket import Trading, Trade, Stock, StockUniverse, TradeSnapshot, TradeGateway, ShardedTrading, \
+    TradePublisher, TradeReader, TradeWindow, METRICS, to_ns, parse_iso
 from features.environment import preload_stocks, preload_trades
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from math import isclose
+import numpy as np
+
+
+def read_published(name, results):     # reader process of test_shared_memory
+    with TradeReader(name) as reader:
+        trading = reader.trading()
+        results.put((trading.size, trading.weighted_price('TEA')))
 
 
 class TestTrading(unittest.TestCase):
@@ -60,6 +75,34 @@ class TestTrading(unittest.TestCase):
             self.trading + 1
             self.trading + self.bad_trading_list
 
+    def test_shared_storage(self):
+        """
+        Adding shares the storage instead of copying it. Every trading keeps seeing its own trades
+        trading += trade adds in place
+        """
+        stock = self.single_trade.stock
+        base = Trading(self.trading_list, columnar=self.trading.columns is not None)
+        view = base.filter(symbol=stock.symbol)
+        grown = base + Trade(stock, 7, 'buy', 1.0)
+        storage = (lambda x: x.columns.data['price']) if base.columns is not None else (lambda x: x.trading_list)
+        self.assertIs(storage(grown), storage(base))
+        grown += [Trade(stock, 8, 'buy', 1.0), Trade(stock, 9, 'sell', 1.0)]
+        self.assertIs(storage(grown), storage(base))
+        self.assertEqual(len(grown.to_list()), 9)
+        self.assertEqual(len(base.to_list()), 6)
+        self.assertEqual(len(base.filter(symbol=stock.symbol).to_list()), 2)
+        self.assertEqual(len(view.to_list()), 2)
+        self.assertEqual(len(grown.filter(symbol=stock.symbol).to_list()), 5)
+        self.assertEqual(grown.order_by('-quantity').first().quantity, 1897)
+        self.assertAlmostEqual(base.weighted_price(stock.symbol), self.trading.weighted_price(stock.symbol),
+                               delta=1e-9)
+
+        forked = base + Trade(stock, 10, 'sell', 1.0)       # base is not the latest one: copies
+        self.assertIsNot(storage(forked), storage(base))
+        self.assertEqual([x.quantity for x in forked.filter(symbol=stock.symbol).to_list()][-1], 10)
+        self.assertEqual([x.quantity for x in grown.filter(symbol=stock.symbol).to_list()][-1], 9)
+        self.assertEqual(len((grown + grown).to_list()), 18)
+
     def test_trading_filters(self):
         """
         filter: gets a list of trades filtered by criteria
@@ -127,6 +170,741 @@ class TestTrading(unittest.TestCase):
         self.assertAlmostEqual(antes.weighted_price('TEA'), 234.83333, delta=1e-5)
         self.assertAlmostEqual(self.trading.geometric_mean(), 201.35, delta=1e-2)
 
+        table, mean = self.trading.stock_index()
+        self.assertEqual(list(table), self.trading.get_symbols())
+        for symbol, price in table.items():
+            self.assertAlmostEqual(price, self.trading.weighted_price(symbol), delta=1e-9)
+        self.assertAlmostEqual(mean, self.trading.geometric_mean(), delta=1e-9)
+        with self.assertRaises(Exception):
+            Trading().stock_index()
+
+        self.assertAlmostEqual(beberagestockmarket.gmean([1, 4, 16]), 4.0, delta=1e-12)
+        self.assertAlmostEqual(beberagestockmarket.gmean([201.35, 1e-3, 1e6]), (201.35 * 1e-3 * 1e6) ** (1 / 3),
+                               delta=1e-9)
+        self.assertEqual(beberagestockmarket.gmean([5.0, 0.0]), 0.0)
+
+    def test_weighted_price_precision(self):
+        """
+        Weighted prices are accumulated in float64. A float32 matrix loses the small trade
+        """
+        stock = self.single_trade.stock
+        trading = Trading([Trade(stock, 10 ** 8, 'buy', 1234.5678), Trade(stock, 3, 'sell', 0.0001)],
+                          columnar=self.trading.columns is not None)
+        target = (10 ** 8 * 1234.5678 + 3 * 0.0001) / (10 ** 8 + 3)
+        self.assertAlmostEqual(trading.weighted_price(stock.symbol), target, delta=1e-9)
+        self.assertAlmostEqual(trading.stock_index()[0][stock.symbol], target, delta=1e-9)
+
+    def test_running_totals(self):
+        """
+        Weighted prices and geometric mean are kept up to date on every addition (Trading += Trade or list)
+        and match a full recalculation
+        """
+        trading = Trading(columnar=self.trading.columns is not None)
+        for trade in self.trading_list:
+            trading += trade
+            table, mean = trading.stock_index()
+            for symbol, price in table.items():
+                self.assertAlmostEqual(trading.weighted_price(symbol), price, delta=1e-9)
+            self.assertAlmostEqual(trading.geometric_mean(), mean, delta=1e-9)
+        trading += self.trading_list
+        self.assertAlmostEqual(trading.geometric_mean(), self.trading.geometric_mean(), delta=1e-9)
+        self.assertAlmostEqual(self.trading.geometric_mean(), 201.35, delta=1e-2)
+
+        with self.assertRaises(Exception):
+            trading.weighted_price('XXX')
+        with self.assertRaises(Exception):
+            Trading().geometric_mean()
+
+    def test_window_weighted_price(self):
+        """
+        weighted_price(symbol, window=timedelta) gets the Volume Weighted Stock Price of the last trades
+        as filtering with after(now - window).before(now)
+        Old buckets expire as newer trades come
+        """
+        window = timedelta(minutes=5)
+        self.assertAlmostEqual(self.trading.weighted_price('TEA', window=window), 234.83333, delta=1e-5)
+        self.assertAlmostEqual(self.trading.weighted_price('GIN', window=window),
+                               Trading(self.trading.filter(symbol='GIN').after(datetime.utcnow() - window).
+                                       to_list()).weighted_price('GIN'), delta=1e-9)
+        with self.assertRaises(Exception):
+            self.trading.weighted_price('JOE', window=window)       # 6.4 minutes ago
+
+        trading = self.trading + Trade(self.single_trade.stock, 750, 'buy', 100.0, datetime.utcnow())
+        self.assertAlmostEqual(trading.weighted_price(self.single_trade.symbol, window=window),
+                               (250 * 235.0 + 125 * 234.5 + 750 * 100.0) / 1125, delta=1e-9)
+
+        stock = self.single_trade.stock
+        start = datetime(2019, 3, 1, 10)
+        ring = TradeWindow(timedelta(minutes=1), buckets=6)
+        ring.add_trades([Trade(stock, 10, 'buy', 10.0, start), Trade(stock, 10, 'buy', 20.0, start)])
+        self.assertEqual(ring.weighted_price(stock.symbol, start), 15.0)
+        ring.add_trade(Trade(stock, 10, 'buy', 40.0, start + timedelta(seconds=90)))
+        self.assertEqual(ring.weighted_price(stock.symbol, start + timedelta(seconds=90)), 40.0)
+        ring.add_trade(Trade(stock, 10, 'buy', 80.0, start))                        # out of the window
+        self.assertEqual(ring.weighted_price(stock.symbol, start + timedelta(seconds=90)), 40.0)
+        with self.assertRaises(Exception):
+            ring.weighted_price(stock.symbol, start + timedelta(minutes=5))
+
+    def test_bars(self):
+        """
+        OHLCV bars per symbol, kept up to date on additions whatever the order of the trades
+        """
+        def expected(trades, symbol, width):
+            bars = {}
+            for trade in sorted((x for x in trades if x.symbol == symbol), key=lambda x: x.ns):
+                bars.setdefault(trade.ns // width * width, []).append(trade)
+            return [(start, x[0].price, max(y.price for y in x), min(y.price for y in x), x[-1].price,
+                     sum(y.quantity for y in x), sum(y.quantity * y.price for y in x) / sum(y.quantity for y in x),
+                     len(x)) for start, x in sorted(bars.items())]
+
+        def found(bars):
+            return [tuple(x) for x in bars.tolist()]
+
+        trades = self.trading_list
+        for width in (timedelta(seconds=1), timedelta(minutes=1), timedelta(minutes=5)):
+            nanoseconds = width // timedelta(microseconds=1) * 1000
+            for symbol in self.trading.get_symbols():
+                bars = found(self.trading.bars(symbol, width))
+                self.assertEqual(len(bars), len(expected(trades, symbol, nanoseconds)))
+                for bar, target in zip(bars, expected(trades, symbol, nanoseconds)):
+                    self.assertEqual(bar[:6] + bar[7:], target[:6] + target[7:])
+                    self.assertAlmostEqual(bar[6], target[6])
+
+        trading = Trading(columnar=self.trading.columns is not None)
+        trading.bars('TEA')
+        for trade in reversed(trades):      # one by one and late
+            trading += trade
+        late = Trade(self.single_stock, 10, 'buy', 1.0, min(x.timestamp for x in trades) - timedelta(hours=1))
+        trading += [late]
+        target = expected(trades + [late], 'TEA', 60 * 10 ** 9)
+        self.assertEqual([x[:6] for x in found(trading.bars('TEA'))], [x[:6] for x in target])
+        self.assertEqual(found(trading.bars('TEA', start=late.timestamp + timedelta(minutes=1))),
+                         found(self.trading.bars('TEA')))
+        self.assertEqual(len(trading.bars('TEA', end=late.timestamp + timedelta(minutes=1))), 1)
+        self.assertEqual([x[:6] for x in found(self.trading.filter(op='buy').bars('TEA'))],
+                         [x[:6] for x in expected([x for x in trades if x.op == 'buy'], 'TEA', 60 * 10 ** 9)])
+        self.assertEqual(len(trading.bars('XXX')), 0)
+
+        before = found(trading.bars('TEA'))
+        preview = trading + Trade(self.single_stock, 5, 'buy', 1.0, late.timestamp)      # + leaves trading as it was
+        self.assertEqual(found(trading.bars('TEA')), before)
+        self.assertIn(timedelta(minutes=1), trading.candles)
+        self.assertEqual(found(preview.bars('TEA'))[0][5], before[0][5] + 5)
+
+    def test_aggregate(self):
+        """
+        Group by symbol, op and time buckets in one pass: count, volume, notional, vwap and buy / sell imbalance
+        """
+        width = timedelta(minutes=1)
+        nanoseconds = 60 * 10 ** 9
+        groups = {}
+        for trade in self.trading_list:
+            groups.setdefault((trade.symbol, trade.op, trade.ns // nanoseconds * nanoseconds), []).append(trade)
+        table = self.trading.aggregate(['symbol', 'op', width], list(Trading.aggregations))
+        self.assertEqual([(x['symbol'], x['op'], x['start']) for x in table], sorted(groups))
+        for row in table:
+            trades = groups[row['symbol'], row['op'], row['start']]
+            volume = sum(x.quantity for x in trades)
+            self.assertEqual(row['count'], len(trades))
+            self.assertEqual(row['volume'], volume)
+            self.assertAlmostEqual(row['notional'], sum(x.price * x.quantity for x in trades))
+            self.assertAlmostEqual(row['vwap'], sum(x.price * x.quantity for x in trades) / volume)
+            self.assertEqual(row['buy_volume'] - row['sell_volume'], volume if row['op'] == 'buy' else -volume)
+            self.assertEqual(row['imbalance'], 1.0 if row['op'] == 'buy' else -1.0)
+
+        table = self.trading.aggregate()
+        self.assertEqual(list(table['symbol']), sorted(self.trading.get_symbols()))
+        for row in table:
+            self.assertAlmostEqual(row['vwap'], self.trading.weighted_price(row['symbol']), delta=1e-9)
+        self.assertEqual(self.trading.aggregate('symbol', 'vwap').tolist(), table[['symbol', 'vwap']].tolist())
+        self.assertEqual(len(self.trading.aggregate(width)), len(self.trading.aggregate([width])))
+        sells = self.trading.filter(op='sell').aggregate([], ['count', 'imbalance'])
+        self.assertEqual(sells.tolist(), [(len(self.trading.filter(op='sell').to_list()), -1.0)])
+        self.assertEqual(len(Trading().aggregate(['symbol', width])), 0)
+        with self.assertRaises(Exception):
+            self.trading.aggregate(['price'])
+        with self.assertRaises(Exception):
+            self.trading.aggregate(metrics=['median'])
+
+    def test_result_cache(self):
+        """
+        Calculations on views are cached until trades of their symbols (or any trades) are added
+        """
+        for columnar in (False, True):
+            trading = Trading(self.trading_list, columnar=columnar)
+            other = next(x for x in self.stock_list if x.symbol != 'TEA')
+            buys = trading.filter(op='buy')
+            price = buys.weighted_price('TEA')
+            self.assertEqual(trading.cache.stats()['misses'], 1)
+            self.assertEqual(trading.filter(op='buy').weighted_price('TEA'), price)      # another view, same query
+            self.assertEqual(trading.cache.stats()['hits'], 1)
+
+            trading += Trade(other, 10, 'buy', 1.0, datetime.utcnow())      # other symbol: still valid
+            self.assertEqual(trading.filter(op='buy').weighted_price('TEA'), price)
+            self.assertEqual(trading.cache.stats()['hits'], 2)
+            table, mean = trading.exclude(op='sell').stock_index()
+            self.assertEqual(trading.exclude(op='sell').stock_index(), (table, mean))
+            self.assertEqual(trading.cache.stats()['hits'], 3)
+
+            trading += Trade(self.single_stock, 1000, 'buy', 1.0, datetime.utcnow())
+            trades = [x for x in trading.to_list() if x.symbol == 'TEA' and x.op == 'buy']
+            self.assertAlmostEqual(trading.filter(op='buy').weighted_price('TEA'),
+                                   sum(x.price * x.quantity for x in trades) / sum(x.quantity for x in trades))
+            self.assertNotEqual(trading.exclude(op='sell').geometric_mean(), mean)
+            self.assertEqual(buys.weighted_price('TEA'), price)       # the view keeps its own trades
+
+            fork = buys + Trade(self.single_stock, 1, 'buy', 1000.0, datetime.utcnow())     # an older trading forks
+            self.assertNotEqual(fork.filter(op='buy').weighted_price('TEA'), price)
+            self.assertIsNot(fork.cache, trading.cache)
+
+            trading.cache.size = 2
+            for symbol in trading.get_symbols()[:3]:
+                trading.filter(symbol=symbol).geometric_mean()
+            self.assertEqual(trading.cache.stats()['results'], 2)       # the least recently used went
+
+    def test_metrics(self):
+        """
+        Opt-in instrumentation: nothing is recorded while disabled. Enabled, every filter, query phase and
+        calculation records calls, latencies and rows in and out
+        """
+        METRICS.reset()
+        self.trading.filter(symbol='TEA').to_list()
+        self.assertEqual(METRICS.as_dict(), {})
+
+        METRICS.enable()
+        try:
+            trades = self.trading.filter(symbol='TEA').exclude(op='sell').order_by('-price').to_list()
+            self.trading.weighted_price('TEA')
+        finally:
+            METRICS.disable()
+        metrics = METRICS.as_dict()
+        self.assertEqual(metrics['filter']['count'], 1)
+        self.assertEqual(metrics['query.candidates']['rows_in'], self.trading.size)
+        self.assertEqual(metrics['query.candidates']['rows_out'], len(self.trading.filter(symbol='TEA').to_list()))
+        self.assertEqual(metrics['query.filter']['rows_out'], len(trades))
+        self.assertEqual(metrics['query.order_by']['rows_out'], len(trades))
+        self.assertEqual(metrics['to_list']['rows_out'], len(trades))
+        self.assertEqual(metrics['weighted_price']['histogram']['+Inf'], 1)
+        self.assertGreaterEqual(metrics['to_list']['seconds'], metrics['query.filter']['seconds'])
+
+        self.assertNotIn('rows_out', metrics['filter'])        # filters only record a step
+        self.assertEqual(Trading.to_list.__name__, 'to_list')
+
+        text = METRICS.prometheus()
+        families = [x.split()[2] for x in text.splitlines() if x.startswith('# TYPE')]
+        current = None
+        for line in text.splitlines():      # every sample right under the TYPE of its family
+            if line.startswith('# TYPE'):
+                current = line.split()[2]
+            else:
+                self.assertTrue(line.startswith(current), line)
+        self.assertEqual(len(families), len(set(families)))
+        self.assertNotIn('trading_operation_rows_out_total{operation="filter"}', text)
+        self.assertIn('trading_operation_seconds_count{operation="to_list"} 1', text)
+        self.assertIn('trading_operation_seconds_bucket{operation="filter",le="+Inf"} 1', text)
+        self.assertIn('trading_operation_rows_out_total{{operation="query.filter"}} {}'.format(len(trades)), text)
+        METRICS.reset()
+
+    def test_lookups(self):
+        """
+        Range and set lookups (attribute__lookup=value) in filter and exclude, chained with any other filter
+        """
+        def rows(trades):
+            return [(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trades]
+
+        trades = self.trading_list
+        times = sorted(x.timestamp for x in trades)
+        low, high = times[1], times[-2]
+        cases = [({'price__gt': 200}, lambda x: x.price > 200),
+                 ({'price__gte': 250, 'op': 'buy'}, lambda x: x.price >= 250 and x.op == 'buy'),
+                 ({'quantity__lt': 400}, lambda x: x.quantity < 400),
+                 ({'quantity__lte': 400, 'symbol': 'TEA'}, lambda x: x.quantity <= 400 and x.symbol == 'TEA'),
+                 ({'quantity__between': (100, 1000)}, lambda x: 100 <= x.quantity <= 1000),
+                 ({'symbol__in': ['POP', 'GIN', 'XXX']}, lambda x: x.symbol in ('POP', 'GIN')),
+                 ({'stock__in': {self.single_stock}}, lambda x: x.stock is self.single_stock),
+                 ({'op__in': ['sell']}, lambda x: x.op == 'sell'),
+                 ({'symbol__in': []}, lambda x: False),
+                 ({'timestamp__gt': low}, lambda x: x.timestamp > low),
+                 ({'timestamp__lt': high.isoformat()}, lambda x: x.timestamp < high),
+                 ({'timestamp__between': (low, high), 'price__lte': 250}, lambda x: low <= x.timestamp <= high and
+                  x.price <= 250),
+                 ({'timestamp__in': [low, high]}, lambda x: x.timestamp in (low, high)),
+                 ({'quantity__in': [trades[0].quantity + 0.5, float(trades[1].quantity)]},
+                  lambda x: x.quantity in (trades[0].quantity + 0.5, trades[1].quantity))]
+        for kwargs, test in cases:
+            self.assertEqual(rows(self.trading.filter(**kwargs).to_list()), rows(filter(test, trades)))
+            if len(kwargs) == 1:
+                self.assertEqual(rows(self.trading.exclude(**kwargs).to_list()),
+                                 rows(x for x in trades if not test(x)))
+        self.assertEqual(rows(self.trading.filter(symbol__in=('TEA', 'POP')).order_by('-price').filter(
+            quantity__gte=100).to_list()), rows(sorted((x for x in trades if x.symbol in ('TEA', 'POP') and
+                                                         x.quantity >= 100), key=lambda x: -x.price)))
+        self.assertEqual(self.trading.filter(price__gt=0).first().price, self.single_trade.price)
+
+        for kwargs in ({'price__near': 1}, {'symbol__gt': 'POP'}, {'price__in': 200}, {'symbol__in': 'POP'},
+                       {'quantity__between': (1, 2, 3)}, {'timestamp__gt': 'yesterday'}, {'colour__in': ['red']}):
+            with self.assertRaises(Exception):
+                self.trading.filter(**kwargs)
+
+    def test_indexes(self):
+        """
+        Filters starting a chain use the symbol and time indexes and get the same trades as a full scan
+        Indexes keep right after adding trades out of time order
+        """
+        def scan(trading, symbol, time):
+            return [x for x in trading.to_list() if x.symbol == symbol and to_ns(x.timestamp) <= to_ns(time)]
+
+        time = datetime.utcnow() - timedelta(minutes=3)
+        self.assertEqual(len(self.trading.filter(symbol='GIN').to_list()), 2)
+        self.assertEqual(len(self.trading.exclude(symbol='GIN').to_list()), 4)
+        self.assertEqual(len(self.trading.filter(stock=self.single_trade.stock).to_list()), 2)
+        self.assertEqual(len(self.trading.before(time).filter(symbol='GIN').to_list()),
+                         len(scan(self.trading, 'GIN', time)))
+
+        stock = self.single_trade.stock
+        trading = self.trading + [Trade(stock, 1, 'buy', 1.0, datetime.utcnow() - timedelta(minutes=10)),
+                                  Trade(stock, 2, 'buy', 1.0, datetime.utcnow() + timedelta(minutes=10))]
+        trading += Trade(stock, 3, 'sell', 1.0, datetime.utcnow() - timedelta(minutes=20))
+        ordered = trading.order_by('timestamp').to_list()
+        self.assertEqual([to_ns(x.timestamp) for x in ordered], sorted(to_ns(x.timestamp) for x in ordered))
+        self.assertEqual(ordered[0].quantity, 3)
+        self.assertEqual(len(trading.filter(symbol=stock.symbol).before(time).to_list()),
+                         len(scan(trading, stock.symbol, time)))
+        self.assertEqual(len(trading.before(time).filter(symbol=stock.symbol).to_list()),
+                         len(scan(trading, stock.symbol, time)))
+        self.assertEqual(len(self.trading.filter(symbol=stock.symbol).to_list()), 2)     # original trading untouched
+
+        streamed = Trading(columnar=self.trading.columns is not None)     # one by one, batches in between
+        for number, trade in enumerate(self.trading_list * 20):
+            streamed += trade
+            if number % 7 == 0:
+                streamed += self.trading_list[:2]
+        rows = [(x.symbol, x.op, x.quantity, x.ns) for x in streamed.to_list()]
+        self.assertEqual([(x.symbol, x.op, x.quantity, x.ns) for x in streamed.filter(symbol='TEA').to_list()],
+                         [x for x in rows if x[0] == 'TEA'])
+        self.assertEqual(len(streamed.index.symbols['TEA']), 1)        # buffered single trades joined on lookup
+        self.assertEqual([x.ns for x in streamed.order_by('timestamp').to_list()], sorted(x[3] for x in rows))
+
+    def test_concurrent_merge(self):
+        """
+        Many threads querying by time at once, the first query merging an out of order book, all get every trade
+        """
+        number = 200000
+        timestamps = np.random.default_rng(0).permutation(number).astype(np.int64) * 1000
+        for _ in range(3):
+            trading = Trading.from_arrays(['TEA'] * number, np.ones(number, dtype=np.int64), ['buy'] * number,
+                                          np.ones(number), timestamps, stocks=self.stock_list,
+                                          columnar=self.trading.columns is not None)
+            start = threading.Barrier(16)
+
+            def query(_):
+                start.wait()
+                return len(trading.index.between(0, None))
+
+            with ThreadPoolExecutor(16) as executor:
+                self.assertEqual(set(executor.map(query, range(16))), {number})
+
+    def test_lazy_query(self):
+        """
+        Chained filters are only recorded (TradingQuery) and run all together by to_list() or first()
+        first() gets the same trade as to_list()[0]
+        """
+        time = datetime.utcnow() - timedelta(minutes=2)
+        chains = [lambda x: x.filter(op='sell').exclude(symbol='MIL').before(time),
+                  lambda x: x.exclude(op='buy').order_by('-price').order_by('symbol'),
+                  lambda x: x.after(time - timedelta(minutes=5)).filter(symbol='GIN').order_by('-timestamp'),
+                  lambda x: x.order_by().filter(quantity=125)]
+        for chain in chains:
+            query = chain(self.trading).query
+            self.assertTrue(query.steps)
+            trades = chain(self.trading).to_list()
+            self.assertFalse(self.trading.query.steps)
+            listed = [x for x in chain(Trading(self.trading_list)).to_list()]
+            self.assertEqual([(x.symbol, x.op, x.quantity) for x in trades],
+                             [(x.symbol, x.op, x.quantity) for x in listed])
+            first = chain(self.trading).first()
+            self.assertEqual((first.symbol, first.quantity), (trades[0].symbol, trades[0].quantity))
+        ordered = self.trading.exclude(op='buy').order_by('-price').order_by('symbol').to_list()
+        self.assertEqual([x.price for x in ordered], [189.0, 199.0, 188.0, 234.5])
+
+        with self.assertRaises(Exception):
+            self.trading.filter(symbol='XXX').first()
+
+    def test_views(self):
+        """
+        Every filter returns an independent view. Abandoned chains don't change the trading and
+        many threads can query the same trading at once
+        """
+        abandoned = self.trading.filter(symbol='TEA').exclude(op='sell')
+        self.assertEqual(len(self.trading.to_list()), 6)
+        self.assertEqual(len(abandoned.filter(op='buy').to_list()), 1)
+        self.assertEqual(abandoned.get_symbols(), ['TEA'])
+        self.assertEqual(abandoned.weighted_price('TEA'), 235.0)
+        self.assertAlmostEqual(self.trading.filter(symbol='TEA').geometric_mean(), 234.83333, delta=1e-5)
+        self.assertEqual(len((abandoned + self.single_trade).to_list()), 2)
+
+        trading = self.trading + [Trade(x.stock, x.quantity, x.op, x.price, x.timestamp + timedelta(seconds=y))
+                                  for x in self.trading_list for y in range(1, 50)]
+        time = datetime.utcnow() - timedelta(minutes=3)
+        queries = [lambda: trading.filter(symbol='GIN').before(time).to_list(),
+                   lambda: trading.exclude(symbol='GIN').after(time).order_by('-price').to_list(),
+                   lambda: trading.filter(op='sell').order_by('quantity').to_list()]
+        expected = [[id(y) for y in x()] for x in queries] if trading.columns is None else \
+            [[(y.symbol, y.quantity, y.timestamp) for y in x()] for x in queries]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda x: queries[x % 3](), range(60)))
+        for number, result in enumerate(results):
+            got = [id(y) for y in result] if trading.columns is None else \
+                [(y.symbol, y.quantity, y.timestamp) for y in result]
+            self.assertEqual(got, expected[number % 3])
+
+    def test_bulk_load(self):
+        """
+        Trading.from_csv loads trades in chunks checking whole columns. Stock.from_csv loads a stock registry
+        """
+        stocks = Stock.from_csv('features/fixtures/stocks.csv')
+        self.assertEqual(list(stocks), [x.symbol for x in self.stock_list])
+        self.assertEqual(stocks['GIN'].fixed_dividend, 0.02)
+
+        rows = ['symbol,op,quantity,price,timestamp']
+        rows += ['{}, {} ,{},{},{}'.format(x.symbol, x.op.upper(), x.quantity, x.price, x.timestamp.isoformat())
+                 for x in self.trading_list]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'trades.csv')
+            with open(path, 'w') as csv_file:
+                csv_file.write('\n'.join(rows))
+            for columnar in (True, False):
+                trading = Trading.from_csv(path, stocks, columnar=columnar, chunk=4)
+                self.assertEqual([(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trading.to_list()],
+                                 [(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in self.trading_list])
+                self.assertAlmostEqual(trading.geometric_mean(), self.trading.geometric_mean(), delta=1e-9)
+
+            with open(path, 'w') as csv_file:       # blank lines are skipped
+                csv_file.write('\n'.join(rows[:3] + [''] * 5 + rows[3:]) + '\n\n')
+            self.assertEqual(len(Trading.from_csv(path, stocks, chunk=4).to_list()), len(self.trading_list))
+            with open(path, 'w') as csv_file:
+                csv_file.write('\n'.join(rows + ['TEA,buy,1']))
+            with self.assertRaisesRegex(Exception, '3 fields, 5 expected'):
+                Trading.from_csv(path, stocks)
+
+            for bad in ['XXX,buy,1,1.0,', 'TEA,lend,1,1.0,', 'TEA,buy,1.5,1.0,', 'TEA,buy,1,cheap,',
+                        'TEA,buy,1,1.0,yesterday']:
+                with open(path, 'w') as csv_file:
+                    csv_file.write('\n'.join(rows + [bad]))
+                with self.assertRaises(Exception):
+                    Trading.from_csv(path, stocks)
+
+    def test_journal(self):
+        """
+        trades are written to an append-only journal and a trading is served from it mapped in memory
+        """
+        def rows(trading):
+            return [(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trading.to_list()]
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'trades.journal')
+            trading = self.trading + []
+            journal = trading.record(path)
+            trading += Trade(self.single_stock, 7, 'sell', 12.5, datetime(2019, 3, 1))
+            trading += self.trading_list[:2]
+            with self.assertRaises(Exception):
+                trading + 1
+            preview = trading + Trade(self.single_stock, 9, 'buy', 9.0, datetime(2019, 3, 1))   # not journaled
+            trading += Trade(self.single_stock, 8, 'buy', 8.0, datetime(2019, 3, 1))      # trading still is
+            self.assertIs(trading.journal, journal)
+            self.assertIsNone(preview.journal)
+            journal.close()
+
+            size, vwap = trading.size, trading.weighted_price('TEA')     # a failed write adds nothing
+            for other in (Trade(self.single_stock, 9, 'buy', 9.0), self.trading_list[:2], self.trading + []):
+                with self.assertRaises(ValueError):
+                    trading += other
+                self.assertEqual((trading.size, trading.weighted_price('TEA')), (size, vwap))
+
+            served = Trading.from_journal(path, self.stock_list)
+            self.assertEqual(rows(served), rows(trading))
+            self.assertAlmostEqual(served.geometric_mean(), trading.geometric_mean(), delta=1e-9)
+            self.assertEqual(served.weighted_price('TEA'), trading.weighted_price('TEA'))
+            self.assertEqual(rows(served.filter(symbol='TEA').order_by('-price')),
+                             rows(trading.filter(symbol='TEA').order_by('-price')))
+            served += Trade(self.single_stock, 1, 'buy', 1.0)       # mapped columns are copied, not written
+            self.assertEqual(served.size, trading.size + 1)
+
+            with open(path, 'ab') as journal_file:      # a crash while writing a record
+                journal_file.write(b'torn')
+            self.assertEqual(Trading.from_journal(path, self.stock_list).size, trading.size)
+            appended = Trading.from_journal(path, self.stock_list, append=True)
+            appended += Trade(self.single_stock, 3, 'buy', 2.0, datetime(2019, 3, 2))
+            appended.journal.close()
+            self.assertEqual(rows(Trading.from_journal(path, self.stock_list))[-1],
+                             ('TEA', 'buy', 3, 2.0, datetime(2019, 3, 2)))
+
+            with self.assertRaises(Exception):
+                Trading.from_journal(path, [x for x in self.stock_list if x.symbol != 'TEA'])
+            with self.assertRaises(Exception):
+                Trading.from_journal('features/fixtures/trades.csv', self.stock_list)
+
+    def test_snapshot(self):
+        """
+        a trading and its stocks are saved as columns and loaded back as they were
+        """
+        def rows(trading):
+            return [(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trading.to_list()]
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'trading.snapshot')
+            for compress in (False, True):
+                self.trading.save(path, compress=compress)
+                trading, stocks = TradeSnapshot.load(path, columnar=compress)
+                self.assertEqual(rows(trading), rows(self.trading))
+                self.assertEqual(trading.weighted_price('TEA'), self.trading.weighted_price('TEA'))
+                for stock in stocks.values():
+                    original = next(x for x in self.stock_list if x.symbol == stock.symbol)
+                    self.assertEqual([getattr(stock, x) for x in Stock.__slots__],
+                                     [getattr(original, x) for x in Stock.__slots__])
+
+            view = self.trading.filter(symbol='GIN').order_by('-price')
+            view.save(path)
+            self.assertEqual(rows(TradeSnapshot.load(path)[0]), rows(view))
+
+            with open(path, 'r+b') as snapshot:     # corrupted
+                snapshot.seek(os.path.getsize(path) // 2)
+                byte = snapshot.read(1)
+                snapshot.seek(-1, os.SEEK_CUR)
+                snapshot.write(bytes([byte[0] ^ 0xFF]))
+            with self.assertRaises(Exception):
+                TradeSnapshot.load(path)
+            with self.assertRaises(Exception):
+                TradeSnapshot.load('features/fixtures/trades.csv')
+
+    def test_gateway(self):
+        """
+        trades sent to the gateway as lines or binary records are added to the trading in bulk
+        """
+        def rows(trading):
+            return sorted((x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trading.to_list())
+
+        async def feed(address, trading):
+            gateway = await TradeGateway(trading, self.stock_list, batch=4, depth=2).start(address)
+            await asyncio.gather(TradeGateway.produce(gateway.address, self.trading, chunk=3),
+                                 TradeGateway.produce(gateway.address, self.trading, binary=True, chunk=5))
+            reader, writer = await asyncio.open_connection(*gateway.address) if isinstance(address, tuple) \
+                else await asyncio.open_unix_connection(address)
+            writer.write(b'XXX,buy,1,1.0\nTEA,lend,1,1.0\nTEA,buy,1\nTEA, SELL ,2,3.5,2019-03-01T10:00:00Z')
+            writer.write_eof()
+            await reader.read()
+            writer.close()
+            await gateway.stop()
+            return gateway.metrics()
+
+        with tempfile.TemporaryDirectory() as folder:
+            for address in (('127.0.0.1', 0), os.path.join(folder, 'trades.sock')):
+                trading = Trading(columnar=self.trading.columns is not None)
+                metrics = asyncio.run(feed(address, trading))
+                expected = self.trading + self.trading + Trade(self.single_stock, 2, 'sell', 3.5,
+                                                               datetime(2019, 3, 1, 10))
+                self.assertEqual(rows(trading), rows(expected))
+                self.assertAlmostEqual(trading.weighted_price('TEA'), expected.weighted_price('TEA'))
+                self.assertEqual(metrics['trades'], trading.size)
+                self.assertEqual((metrics['rejected'], metrics['connections'], metrics['queue_depth']), (3, 3, 0))
+                self.assertLessEqual(metrics['queue_max'], 2)
+                self.assertGreaterEqual(metrics['latency']['max'], metrics['latency']['p50'])
+
+    def test_gateway_failures(self):
+        """
+        a batch failing to be added is rejected and the gateway goes on: flush and stop never hang
+        """
+        async def feed(trading):
+            gateway = await TradeGateway(trading, self.stock_list, batch=100).start(('127.0.0.1', 0))
+            await TradeGateway.produce(gateway.address, self.trading)
+            await asyncio.wait_for(gateway.flush(), 10)
+            del trading._add_arrays
+            await TradeGateway.produce(gateway.address, self.trading)
+            await asyncio.wait_for(gateway.stop(), 10)
+            return gateway.metrics()
+
+        def failing(*args):
+            raise OSError('No space left on device')
+
+        trading = Trading(columnar=self.trading.columns is not None)
+        trading._add_arrays = failing
+        metrics = asyncio.run(feed(trading))
+        self.assertEqual((metrics['failed'], metrics['rejected'], metrics['trades']), (1, self.trading.size,
+                                                                                       self.trading.size))
+        self.assertEqual(trading.size, self.trading.size)
+
+    def test_gateway_bad_lines(self):
+        """
+        wrong lines among good ones are left out in one pass over the whole chunk, not checked one by one
+        """
+        gateway = TradeGateway(Trading(columnar=self.trading.columns is not None), self.stock_list)
+        good = b'TEA,buy,10,2.5,2019-03-01T10:00:00Z\n GIN , SELL ,+3,-1e2,\nJOE,buy,7,.5,2019-03-01 10:00\n'
+        bad = b'XXX,buy,1,1.0,\nTEA,lend,1,1.0,\nTEA,buy,1.5,1.0,\nTEA,buy,--1,1.0,\nTEA,buy,1,1..0,\n' \
+            b'TEA,buy,1,1e,\nTEA,buy,1,x,\nTEA,buy,1,1.0,2019-02-29\nTEA,buy,1,1.0,yesterday\n'
+        checks = []
+        check_arrays = Trading._check_arrays
+        Trading._check_arrays = staticmethod(lambda *args, **kwargs: checks.append(1) or check_arrays(*args, **kwargs))
+        try:
+            stocks, codes, ops, quantities, prices, timestamps = gateway._lines(good * 1000 + bad)
+        finally:
+            Trading._check_arrays = staticmethod(check_arrays)
+        self.assertEqual(len(checks), 2)
+        self.assertEqual(gateway.counts['rejected'], 9)
+        self.assertEqual(len(codes), 3000)
+        self.assertEqual([stocks[x].symbol for x in codes[:3]], ['TEA', 'GIN', 'JOE'])
+        self.assertEqual((quantities[:3].tolist(), prices[:3].tolist()), ([10, 3, 7], [2.5, -100.0, 0.5]))
+        self.assertIsNone(gateway._lines(bad))
+        self.assertEqual(gateway.counts['rejected'], 18)
+
+    def test_sharded(self):
+        """
+        a trading sharded by symbol across processes answers as the trading does
+        """
+        def rows(trades):
+            return [(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trades]
+
+        with ShardedTrading(self.stock_list, shards=3, columnar=self.trading.columns is not None) as sharded:
+            sharded += self.trading_list[:5]
+            sharded += self.trading_list[5]
+            sharded += Trading(self.trading_list[6:])
+            middle = sorted(x.timestamp for x in self.trading_list)[len(self.trading_list) // 2]
+            for query in (lambda x: x, lambda x: x.filter(symbol='TEA'), lambda x: x.exclude(op='sell'),
+                          lambda x: x.order_by('-price'), lambda x: x.after(middle).order_by('symbol'),
+                          lambda x: x.filter(stock=self.single_stock).order_by('-quantity').order_by('op'),
+                          lambda x: x.filter(stock__in=[self.single_stock], price__gt=100).exclude(symbol__in=['GIN'])):
+                self.assertEqual(rows(query(sharded).to_list()), rows(query(self.trading).to_list()))
+                self.assertEqual(rows([query(sharded).first()]), rows([query(self.trading).first()]))
+                self.assertEqual(query(sharded).get_symbols(), query(self.trading).get_symbols())
+                self.assertAlmostEqual(query(sharded).geometric_mean(), query(self.trading).geometric_mean())
+            self.assertEqual(sharded.weighted_price('TEA'), self.trading.weighted_price('TEA'))
+            self.assertEqual(sharded.filter(op='buy').weighted_price('GIN'),
+                             self.trading.filter(op='buy').weighted_price('GIN'))
+            with self.assertRaises(Exception):
+                sharded.filter(symbol='XXX').first()
+            with self.assertRaises(Exception):
+                sharded.filter(colour='red')
+            with self.assertRaises(Exception):
+                sharded.add_arrays(['XXX'], [1], ['buy'], [1.0])
+
+    def test_shared_memory(self):
+        """
+        a trading published in shared memory is queried by readers over the shared columns
+        """
+        def rows(trading):
+            return [(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trading.to_list()]
+
+        trading = Trading(self.trading_list[:4], columnar=self.trading.columns is not None)
+        with TradePublisher(trading, capacity=2, stock_capacity=1) as publisher, TradeReader(publisher.name) as reader:
+            first = reader.trading()
+            self.assertEqual(rows(first), rows(trading))
+            trading += self.trading_list[4:]
+            self.assertEqual(publisher.publish(), len(self.trading_list) - 4)
+            second = reader.trading()
+            self.assertEqual(rows(second), rows(self.trading))
+            self.assertEqual(rows(first), rows(Trading(self.trading_list[:4])))
+            self.assertEqual(rows(second.filter(symbol='GIN').order_by('-price')),
+                             rows(self.trading.filter(symbol='GIN').order_by('-price')))
+            self.assertAlmostEqual(second.geometric_mean(), self.trading.geometric_mean())
+            second += Trade(self.single_stock, 1, 'buy', 1.0)       # copies, the shared columns don't change
+            trading += self.trading_list[2:4]      # published again after appending to a trading handed out
+            publisher.publish()
+            third = reader.trading()
+            self.assertEqual(rows(third), rows(self.trading) + rows(Trading(self.trading_list[2:4])))
+            for symbol in third.get_symbols():
+                self.assertEqual(rows(third.filter(symbol=symbol)),
+                                 [x for x in rows(third) if x[0] == symbol])
+            self.assertEqual(third.stock_index(), (self.trading + self.trading_list[2:4]).stock_index())
+            self.assertEqual(rows(second)[:-1], rows(self.trading))
+            self.assertEqual(rows(second.filter(symbol=self.single_stock.symbol))[-1][2:4], (1, 1.0))
+
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=read_published, args=(publisher.name, results))
+            process.start()
+            self.assertEqual(results.get(timeout=30), (trading.size, trading.weighted_price('TEA')))
+            process.join()
+
+    def test_closed_publisher(self):
+        """
+        readers of a publisher gone (or stopped while publishing) raise instead of waiting forever
+        """
+        trading = Trading(self.trading_list[:2], columnar=True)
+        publisher = TradePublisher(trading, capacity=2)
+        with TradeReader(publisher.name, timeout=0.1) as reader:
+            reader.trading()
+            trading += self.trading_list[2:]
+            publisher.publish()         # a new generation, not attached by the reader yet
+            publisher.values[0] += 1    # as if killed while publishing
+            with self.assertRaisesRegex(Exception, 'stopped while publishing'):
+                reader.trading()
+            publisher.values[0] += 1
+            publisher.close()
+            with self.assertRaisesRegex(Exception, 'no longer published'):
+                reader.trading()
+
+    def test_from_arrays(self):
+        """
+        Trading.from_arrays builds a trading from whole columns checked at once
+        """
+        trades = self.trading_list
+        for symbols in ([x.stock for x in trades], [x.symbol.lower() for x in trades]):
+            trading = Trading.from_arrays(symbols, np.asarray([x.quantity for x in trades]),
+                                          [x.op.upper() for x in trades], [x.price for x in trades],
+                                          [x.timestamp for x in trades], stocks=self.stock_list,
+                                          columnar=self.trading.columns is not None)
+            self.assertEqual([(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trading.to_list()],
+                             [(x.symbol, x.op, x.quantity, x.price, x.timestamp) for x in trades])
+            self.assertAlmostEqual(trading.geometric_mean(), self.trading.geometric_mean(), delta=1e-9)
+        stamps = np.asarray([x.timestamp for x in trades], dtype='datetime64[ns]')
+        self.assertEqual(Trading.from_arrays(['TEA'] * 6, [1] * 6, ['buy'] * 6, [1.0] * 6, stamps.astype(np.int64),
+                                             stocks=self.stock_list).order_by().first().timestamp,
+                         min(x.timestamp for x in trades))
+        self.assertEqual(len(Trading.from_arrays([], [], [], [], stocks=self.stock_list).to_list()), 0)
+
+        bad = [(['XXX'], [1], ['buy'], [1.0]), (['TEA'], [1.5], ['buy'], [1.0]), (['TEA'], [1], ['lend'], [1.0]),
+               (['TEA'], [1], ['buy'], ['cheap']), (['TEA', 'TEA'], [1], ['buy'], [1.0])]
+        for columns in bad:
+            with self.assertRaises(Exception):
+                Trading.from_arrays(*columns, stocks=self.stock_list)
+        with self.assertRaises(Exception):
+            Trade(self.single_stock, 1, 'buy', 1.0, 'yesterday')
+
+    def test_timestamps(self):
+        """
+        timestamps are epoch nanoseconds UTC. Datetimes, ISO strings and nanoseconds give the same trade time
+        """
+        when = datetime(2019, 3, 1, 10, 30, 15, 250000)
+        trades = [Trade(self.single_stock, 1, 'buy', 1.0, x)
+                  for x in (when, when.isoformat(), to_ns(when), '2019-03-01T11:30:15.25+01:00',
+                            np.datetime64('2019-03-01T10:30:15.250'))]
+        self.assertEqual({x.ns for x in trades}, {to_ns(when)})
+        self.assertEqual(trades[1].timestamp, when)
+        self.assertEqual(Trade(self.single_stock, 1, 'buy', 1.0, 0).timestamp, datetime(1970, 1, 1))    # not now
+        for bad in (1551436215.25, when.date(), np.datetime64('NaT'), [when]):
+            with self.assertRaisesRegex(Exception, 'ISO format'):
+                Trade(self.single_stock, 1, 'buy', 1.0, bad)
+        with self.assertRaises(TypeError):
+            to_ns(when.date())
+
+        texts = ['2019-03-01', '2019-03-01T10:30', '2019-03-01 10:30:15', '2019-03-01T10:30:15.123456789',
+                 '2020-02-29T23:59:59.5Z', '2019-03-01T10:30:15.25-05:30', '1969-12-31T23:59:59', '']
+        expected = [datetime(2019, 3, 1), datetime(2019, 3, 1, 10, 30), datetime(2019, 3, 1, 10, 30, 15),
+                    datetime(2019, 3, 1, 10, 30, 15, 123456), datetime(2020, 2, 29, 23, 59, 59, 500000),
+                    datetime(2019, 3, 1, 16, 0, 15, 250000), datetime(1969, 12, 31, 23, 59, 59)]
+        parsed = parse_iso(texts)
+        self.assertEqual(parsed[3] % 1000, 789)
+        self.assertEqual([x // 1000 for x in parsed[:-1]], [to_ns(x) // 1000 for x in expected])
+        self.assertEqual(parsed[-1], np.iinfo(np.int64).min)
+        self.assertEqual(parse_iso([' 2019-03-01\t', '2019-03-01+01:00'])[1], to_ns(datetime(2019, 2, 28, 23)))
+        for text in ('2019-02-29', '2019-13-01', '2019-03-01T25:00', '2019/03/01', '2019-03-01T10:30:15.',
+                     '2019-03', 'now', 'NaT', '2019-03-01T10', '2019-03-01T10:30+1:00'):
+            with self.assertRaises(ValueError):
+                parse_iso([text])
+
+        trading = Trading.from_arrays(['TEA'] * 2, [1] * 2, ['buy'] * 2, [1.0] * 2,
+                                      ['2019-03-01T10:00:00', ''], stocks=self.stock_list)
+        self.assertEqual(trading.order_by().first().timestamp, datetime(2019, 3, 1, 10))
+        self.assertEqual(len(self.trading.after('2019-03-01').to_list()), len(self.trading.to_list()))
+
     def test_stock(self):
         """
         dividend yield: given a price
@@ -159,6 +937,102 @@ class TestTrading(unittest.TestCase):
             stock = next((x for x in self.stock_list if x.symbol == symbol), None)
             self.assertEqual(stock.pe_ratio(price), result if result != 0 else None)
 
+    def test_stock_universe(self):
+        """
+        dividend yield and P/E ratio for whole price vectors and matrices. Masked instead of errors
+        """
+        universe = StockUniverse(self.stock_list)
+        prices = np.array([[225.0, 92, 90, 91, 45], [0, 10, 20, 30, 40]])
+        symbols = ['GIN', 'ALE', 'MOM', 'JOE', 'TEA']
+        yields = universe.dividend_yield(prices, symbols)
+        ratios = universe.pe_ratio(prices, symbols)
+        for row, tick in enumerate(prices):
+            for column, (symbol, price) in enumerate(zip(symbols, tick)):
+                stock = universe[symbol]
+                if price == 0:
+                    self.assertIs(yields[row, column], np.ma.masked)
+                else:
+                    self.assertAlmostEqual(yields[row, column], stock.dividend_yield(price))
+                ratio = stock.pe_ratio(price)
+                if ratio is None:
+                    self.assertIs(ratios[row, column], np.ma.masked)
+                else:
+                    self.assertAlmostEqual(ratios[row, column], ratio)
+        self.assertEqual(universe.pe_ratio(np.full(len(universe), 90.0)).shape, (len(universe),))
+        with self.assertRaises(Exception):
+            universe.dividend_yield([1.0, 2.0])
+        with self.assertRaises(Exception):
+            universe.pe_ratio([1.0], ['XXX'])
+
+
+class TestColumnarTrading(TestTrading):
+    """
+    Same tests over a columnar trading (numpy arrays instead of a list of Trade objects)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+
+        super().setUpClass()
+        cls.list_trading = cls.trading
+        cls.trading = Trading(cls.trading.to_list(), columnar=True)
+
+    def test_columnar_matches_list(self):
+        """
+        Queries on the columnar trading return the same trades as on the list trading
+        Arrays grow past its initial chunk
+        """
+        for field in ['symbol', '-symbol', 'op', '-price', 'quantity', '-timestamp']:
+            columnar = [(x.symbol, x.op, x.quantity, x.price) for x in self.trading.order_by(field).to_list()]
+            listed = [(x.symbol, x.op, x.quantity, x.price) for x in self.list_trading.order_by(field).to_list()]
+            self.assertEqual(columnar, listed)
+        self.assertEqual(self.trading.get_symbols(), self.list_trading.get_symbols())
+        self.assertEqual(len(self.trading.filter(stock=self.single_trade.stock).exclude(op='buy').to_list()),
+                         len(self.list_trading.filter(stock=self.single_trade.stock).exclude(op='buy').to_list()))
+
+        big = Trading(self.trading_list * 500, columnar=True)
+        big += self.trading_list
+        self.assertEqual(len(big.to_list()), 6 * 501)
+        self.assertAlmostEqual(big.geometric_mean(), self.list_trading.geometric_mean(), delta=1e-2)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_startup(self):
+        """
+        Importing the trading module loads no heavy modules: they wait until their features are used
+        """
+        result = benchmarks.startup(1)
+        self.assertEqual(result['modules'], [])
+        self.assertGreater(result['seconds'], 0)
+
+    def test_memory(self):
+        """
+        Slotted trades take less memory than dictionary based ones, and columnar tradings even less
+        """
+        sizes = benchmarks.bytes_per_trade(5000)
+        self.assertLess(sizes['slots'], sizes['dict'])
+        self.assertLess(sizes['columnar'], sizes['slots'])
+
+    def test_suite(self):
+        """
+        Synthetic markets are reproducible, and slower operations than the baseline are regressions
+        """
+        stocks = benchmarks.market(10, seed=1)
+        first, second = benchmarks.generate(2000, stocks, seed=1), benchmarks.generate(2000, stocks, seed=1)
+        for column, same in zip(first, second):
+            self.assertTrue(np.array_equal(column, same))
+        self.assertTrue(np.all(np.diff(first[4]) >= 0))
+        self.assertGreater(np.sum(first[0] == 'AAA'), np.sum(first[0] == 'AAJ'))
+
+        for columnar in (True, False):
+            results = benchmarks.suite([2000], columnar=columnar, symbols=10, seed=1, repeat=1)
+            self.assertIn('{}/ingest/2000'.format('columnar' if columnar else 'list'), results)
+            self.assertEqual(benchmarks.compare(results, results), [])
+        baseline = {key: {'seconds': result['seconds'] / 10 - 1, 'peak': result['peak']}
+                    for key, result in results.items()}
+        self.assertEqual({x[0] for x in benchmarks.compare(results, baseline)}, set(results))
+
 
 if __name__ == '__main__':
     unittest.main()